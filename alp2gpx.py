@@ -23,56 +23,1370 @@ import sys
 from struct import *
 from datetime import datetime
 import base64
-import xml.etree.ElementTree as ET
-import io
 import os
+import mmap
+import math
+import heapq
+import glob
+import time
 import argparse
+import multiprocessing
+import io
+import hashlib
+import zipfile
+import json
+import functools
+from array import array
+from operator import itemgetter, sub, mul, truediv, le, lt
+from itertools import chain, compress, islice, repeat
+from collections import deque
+
+__version__ = '0.2.0'
+
+# sentinels used by {Location} for "no value"
+NO_HEIGHT = -999999999
+NO_PRESSURE = 999999999
+NAN = float('nan')
+
+# segment version <= 3 {Location} records have a fixed layout selected by
+# their size field, so a whole segment can be unpacked in one go:
+# - int         size of the record (without this field)
+# - coordinate  longitude
+# - coordinate  latitude
+# - height      elevation
+# - timestamp   time
+# - int         accuracy (size > 20)
+# - pressure    pressure (size > 24)
+LOCATION_RECORDS = {
+    20: Struct('>llllq'),
+    24: Struct('>llllql'),
+    28: Struct('>llllqll'),
+}
+
+LOCATION_COLUMNS = ('lon', 'lat', 'alt', 'ts', 'acc', 'bar')
+
+# segment version 4 {Location} records are tagged:
+# - int         size of the record (without this field)
+# - coordinate  longitude
+# - coordinate  latitude
+# - then fields of a one byte tag and a value, in any order:
+#   e height, t timestamp, a accuracy (int), p pressure
+LOCATION_TAGS = {
+    ord('e'): ('alt', 'l'),
+    ord('t'): ('ts', 'q'),
+    ord('a'): ('acc', 'l'),
+    ord('p'): ('bar', 'l'),
+}
+
+# size field and coordinates starting every {Location}
+LOCATION_START = Struct('>lll')
+
+# bytes of each field of a version 4 {Location}, tag included
+LOCATION_FIELD_SIZES = {b'e': 5, b't': 9, b'a': 5, b'p': 5}
+
+# tag sequence -> (Struct, key of a row, expected key), compiled on first use
+# (threads compiling the same layout at once store equal values)
+TAGGED_RECORDS = {}
+
+
+def tagged_record(tags):
+    result = TAGGED_RECORDS.get(tags)
+    if result is None:
+        record = Struct('>lll' + ''.join('B' + LOCATION_TAGS[tag][1] for tag in tags))
+        # a row matches the layout when its size and tags are the expected ones
+        fields = [0] + [3 + 2 * i for i in range(len(tags))]
+        expected = (record.size - 4,) + tags
+        key = itemgetter(*fields)
+        if len(fields) == 1:
+            expected = expected[0]
+        result = TAGGED_RECORDS[tags] = (record, key, expected)
+    return result
+
+# first int of a .trk: the file version (2, 3) or the version 4 constant
+TRK_MAGICS = (2, 3, 0x50500e01)
+
+# types of the .ldk data entries
+LDK_TYPES = {101: 'wpt', 102: 'set', 103: 'rte', 104: 'trk', 105: 'are'}
+
+INT = Struct('>l')
+LONG = Struct('>q')
+DOUBLE = Struct('>d')
+POINTER = Struct('>Q')
+
+# smallest size of the items of the counts checked by alp2gpx._count
+MIN_LOCATION = {2: 24, 3: 24, 4: 12}       # size field and record, by segment version
+MIN_SEGMENT = 8
+MIN_META_ENTRY = 8
+NODE_ENTRY = 12
+
+# a damaged record is searched for a following one this many bytes at most
+RESYNC_WINDOW = 1 << 16
+
+
+class FormatError(ValueError):
+    '''
+    Damaged input: offset of the faulty field, its name and the reason.
+    '''
+
+    def __str__(self):
+        return 'offset 0x%X: %s: %s' % self.args
+
+    def as_dict(self):
+        return dict(zip(('offset', 'field', 'reason'), self.args))
+
+
+# what decoding damaged data can raise (struct.error past the end of the data,
+# OverflowError for a pointer beyond any buffer)
+DECODE_ERRORS = (error, ValueError, OverflowError)
+
+
+class Reader(object):
+    '''
+    Big-endian decoder over a memory-mapped file, an in-memory buffer
+    (bytes, bytearray, memoryview) or the content of a binary file object
+    (read once). Values are unpacked in place at a
+    tracked offset with precompiled Structs, raw data is returned as
+    memoryview slices: there is no read() call and no intermediate copy.
+    '''
+
+    def __init__(self, source):
+        self.map = None
+        if isinstance(source, str):
+            with open(source, 'rb') as f:
+                if os.fstat(f.fileno()).st_size:
+                    source = self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    source = b''    # mmap refuses empty files
+        elif hasattr(source, 'read'):
+            source = source.read()
+        self.buffer = memoryview(source)
+        self.size = len(self.buffer)
+        self.offset = 0
+        self.released = 0
+
+    def release(self, offset):
+        # the mapped pages before offset, decoded, are dropped from memory
+        # (read again from the file if needed): the resident size of a long
+        # sequential decode does not grow with the file
+        if self.map is None or not hasattr(mmap, 'MADV_DONTNEED'):
+            return
+        end = offset - offset % mmap.PAGESIZE
+        if end > self.released:
+            self.map.madvise(mmap.MADV_DONTNEED, self.released, end - self.released)
+            self.released = end
+
+    def seek(self, offset):
+        self.offset = offset
+
+    def tell(self):
+        return self.offset
+
+    def read(self, size):
+        start = self.offset
+        self.offset = min(start + size, self.size)
+        return self.buffer[start:self.offset]
+
+    def unpack(self, record):
+        result = record.unpack_from(self.buffer, self.offset)
+        self.offset += record.size
+        return result
+
+    def unpack_at(self, record, offset):
+        return record.unpack_from(self.buffer, offset)
+
+    def int32(self):
+        result = INT.unpack_from(self.buffer, self.offset)[0]
+        self.offset += 4
+        return result
+
+    def int64(self):
+        result = LONG.unpack_from(self.buffer, self.offset)[0]
+        self.offset += 8
+        return result
+
+    def double(self):
+        result = DOUBLE.unpack_from(self.buffer, self.offset)[0]
+        self.offset += 8
+        return result
+
+    def pointer(self):
+        result = POINTER.unpack_from(self.buffer, self.offset)[0]
+        self.offset += 8
+        return result
+
+    def string(self, size):
+        return str(self.read(size), 'UTF-8')
+
+
+class Stats(object):
+    '''
+    Counters and per-phase timings of a conversion (--stats). Phase times
+    are exclusive: time spent in a nested phase (e.g. metadata within
+    header) is not counted again in the enclosing one.
+    '''
+    COUNTERS = ('bytes_read', 'reads', 'seeks', 'points', 'segments', 'waypoints',
+                'ldk_nodes', 'ldk_entries', 'output_bytes', 'points_removed',
+                'duplicates')
+
+    def __init__(self):
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        self.seconds = {}
+        self._stack = []
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self._stack:
+            parent = self._stack[-1]
+            self.seconds[parent[0]] = self.seconds.get(parent[0], 0.0) + now - parent[1]
+        self._stack.append([phase, now])
+
+    def leave(self):
+        now = time.perf_counter()
+        phase, started = self._stack.pop()
+        self.seconds[phase] = self.seconds.get(phase, 0.0) + now - started
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def as_dict(self):
+        result = dict((name, getattr(self, name)) for name in self.COUNTERS)
+        result['seconds'] = dict(self.seconds)
+        return result
+
+    def add(self, other):
+        # accumulate another Stats, or its as_dict()
+        if isinstance(other, Stats):
+            other = other.as_dict()
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + other[name])
+        for phase, seconds in other['seconds'].items():
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+
+def timed(phase):
+    # time a method of alp2gpx as phase when it has a Stats
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.stats is None:
+                return method(self, *args, **kwargs)
+            self.stats.enter(phase)
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                self.stats.leave()
+        return wrapper
+    return decorate
+
+
+class CountingReader(Reader):
+    '''
+    Reader counting seeks, decoding calls (reads: one per value or slice,
+    what used to be one file read each) and bytes decoded into a Stats;
+    only used when statistics are requested, so the plain Reader pays
+    nothing.
+    '''
+
+    def __init__(self, source, stats):
+        Reader.__init__(self, source)
+        self.stats = stats
+
+    def seek(self, offset):
+        self.stats.seeks += 1
+        self.offset = offset
+
+    def read(self, size):
+        result = Reader.read(self, size)
+        self.stats.reads += 1
+        self.stats.bytes_read += len(result)
+        return result
+
+    def unpack(self, record):
+        self.stats.reads += 1
+        self.stats.bytes_read += record.size
+        return Reader.unpack(self, record)
+
+    def unpack_at(self, record, offset):
+        self.stats.reads += 1
+        self.stats.bytes_read += record.size
+        return Reader.unpack_at(self, record, offset)
+
+    def int32(self):
+        self.stats.reads += 1
+        self.stats.bytes_read += 4
+        return Reader.int32(self)
+
+    def int64(self):
+        self.stats.reads += 1
+        self.stats.bytes_read += 8
+        return Reader.int64(self)
+
+    def double(self):
+        self.stats.reads += 1
+        self.stats.bytes_read += 8
+        return Reader.double(self)
+
+    def pointer(self):
+        self.stats.reads += 1
+        self.stats.bytes_read += 8
+        return Reader.pointer(self)
+
+
+class Point(object):
+    '''
+    View of one location of a Segment, for callers iterating point by point.
+    Also readable as a mapping: point['lat'] (missing values are NaN).
+    '''
+    __slots__ = ('segment', 'index')
+
+    def __init__(self, segment, index):
+        self.segment = segment
+        self.index = index
+
+    def __getitem__(self, name):
+        if name not in LOCATION_COLUMNS:
+            raise KeyError(name)
+        return getattr(self.segment, name)[self.index]
+
+    def __repr__(self):
+        return 'Point(%s)' % ', '.join('%s=%r' % (name, self[name]) for name in LOCATION_COLUMNS)
+
+    lon = property(lambda self: self.segment.lon[self.index])
+    lat = property(lambda self: self.segment.lat[self.index])
+    alt = property(lambda self: self.segment.alt[self.index])
+    ts = property(lambda self: self.segment.ts[self.index])
+    acc = property(lambda self: self.segment.acc[self.index])
+    bar = property(lambda self: self.segment.bar[self.index])
+
+
+class Segment(object):
+    '''
+    Locations of one track segment stored as columns of doubles
+    (8 bytes per value, NaN for missing height/accuracy/pressure):
+    lon, lat (degrees), alt (m), ts (s), acc, bar.
+    '''
+    __slots__ = ('meta',) + LOCATION_COLUMNS
+
+    def __init__(self, meta=None, **columns):
+        self.meta = meta if meta is not None else {}
+        for name in LOCATION_COLUMNS:
+            setattr(self, name, columns.get(name, array('d')))
+
+    def __len__(self):
+        return len(self.ts)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('segment index out of range')
+        return Point(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield Point(self, index)
+
+    def append(self, location):
+        # location: dict as returned by alp2gpx._get_location
+        for name in LOCATION_COLUMNS:
+            value = location[name]
+            getattr(self, name).append(NAN if value is None else value)
+
+
+class Track(object):
+    '''
+    A decoded track: metadata, waypoints and segments. segments is either a
+    list of Segment or, while converting, a generator decoding them lazily
+    (the counts decode it into a list, see decoded_segments).
+    kind is the LDK_TYPES name of what it was read from: trk, or for the
+    other .ldk entries wpt and set (waypoints only), rte (the route points
+    in waypoints) and are (the outline of the area as one segment).
+    parts, when the decoder can give them, is a generator of the same
+    segments in (new, Segment) parts of bounded size, new for the first
+    part of a segment: the converter writes those when nothing needs
+    whole segments, so memory does not grow with the segment length.
+    Only one of segments and parts can be iterated.
+    '''
+    __slots__ = ('version', 'metadata', 'waypoints', 'segments', 'kind', 'parts')
+
+    def __init__(self, version, metadata, waypoints, segments, kind='trk', parts=None):
+        self.version = version
+        self.metadata = metadata
+        self.waypoints = waypoints
+        self.segments = segments
+        self.kind = kind
+        self.parts = parts
+
+    def decoded_segments(self):
+        # the segments as a list: a generator is decoded once, the list
+        # replaces it so the track keeps its points
+        if not isinstance(self.segments, list):
+            self.segments = list(self.segments)
+        return self.segments
+
+    def number_of_segments(self):
+        return len(self.decoded_segments())
+
+    def number_of_locations(self):
+        return sum(len(s) for s in self.decoded_segments())
+
+
+# metres per degree of latitude (mean Earth radius 6371008.8 m)
+METRES_PER_DEGREE = 6371008.8 * math.pi / 180
+
+
+class Simplifier(object):
+    '''
+    Point reduction stage between the decoder and the writer, applied to
+    each Segment as it is decoded, in this order:
+    - stationary: runs of points staying within stationary metres of their
+      first point for at least stationary_time seconds are reduced to
+      their first and last points,
+    - min_distance (m) / min_time (s): points closer to, or sooner after,
+      the last kept point are dropped,
+    - tolerance (m): Douglas-Peucker, on windows of window points (the
+      window ends are kept), distances to the chord of each step computed
+      over the window in a local equirectangular projection.
+    First and last points of a segment are always kept. Every pass is
+    linear, Douglas-Peucker O(n log window) typically and O(n window) at
+    worst; besides the output, memory is the index array (8 bytes per
+    point) and one window.
+    '''
+    window = 4096
+
+    def __init__(self, tolerance=None, min_distance=None, min_time=None, stationary=None,
+                 stationary_time=60.0, stats=None):
+        self.tolerance = tolerance
+        self.min_distance = min_distance
+        self.min_time = min_time
+        self.stationary = stationary
+        self.stationary_time = stationary_time
+        self.stats = stats
+        self.points = 0     # points in
+        self.removed = 0
+
+    def segments(self, segments):
+        for segment in segments:
+            yield self.segment(segment)
+
+    @timed('simplify')
+    def segment(self, segment):
+        n = len(segment)
+        self.points += n
+        if n <= 2:
+            return segment
+        indices = array('q', range(n))
+        if self.stationary:
+            indices = self._stationary(segment, indices)
+        if self.min_distance or self.min_time:
+            indices = self._decimate(segment, indices)
+        if self.tolerance:
+            indices = self._douglas_peucker(segment, indices)
+        removed = n - len(indices)
+        self.removed += removed
+        if self.stats is not None:
+            self.stats.points_removed += removed
+        if not removed:
+            return segment
+        columns = dict((name, array('d', map(getattr(segment, name).__getitem__, indices)))
+                       for name in LOCATION_COLUMNS)
+        return Segment(segment.meta, **columns)
+
+    def _stationary(self, segment, indices):
+        lon, lat, ts = segment.lon, segment.lat, segment.ts
+        radius2 = (self.stationary / METRES_PER_DEGREE) ** 2
+        result = array('q')
+        n = len(indices)
+        start = 0
+        while start < n:
+            first = indices[start]
+            x0, y0 = lon[first], lat[first]
+            kx2 = math.cos(math.radians(y0)) ** 2
+            end = start + 1
+            while end < n:
+                i = indices[end]
+                if (lon[i] - x0) ** 2 * kx2 + (lat[i] - y0) ** 2 > radius2:
+                    break
+                end += 1
+            last = indices[end - 1]
+            if end - start > 2 and ts[last] - ts[first] >= self.stationary_time:
+                result.append(first)
+                result.append(last)
+            else:
+                result.extend(indices[start:end])
+            start = end
+        return result
+
+    def _decimate(self, segment, indices):
+        lon, lat, ts = segment.lon, segment.lat, segment.ts
+        distance2 = ((self.min_distance or 0) / METRES_PER_DEGREE) ** 2
+        min_time = self.min_time
+        last = indices[0]
+        kx2 = math.cos(math.radians(lat[last])) ** 2
+        result = array('q', [last])
+        for i in indices[1:-1]:
+            # time only counts with min_time; an unknown (NaN) time difference is far enough
+            if ((not min_time or not ts[i] - ts[last] < min_time) and
+                    (lon[i] - lon[last]) ** 2 * kx2 + (lat[i] - lat[last]) ** 2 >= distance2):
+                result.append(i)
+                last = i
+        result.append(indices[-1])
+        return result
+
+    def _douglas_peucker(self, segment, indices):
+        result = array('q')
+        for start in range(0, len(indices) - 1, self.window):
+            # windows share their end points
+            kept = self._douglas_peucker_window(segment, indices[start:start + self.window + 1])
+            result.extend(kept[:-1])
+        result.append(indices[-1])
+        return result
+
+    @staticmethod
+    def _to_chord(x, y, dx, dy):
+        # distance of (x, y) to the chord from (0, 0) to (dx, dy)
+        chord2 = dx * dx + dy * dy
+        t = min(1.0, max(0.0, (x * dx + y * dy) / chord2)) if chord2 else 0.0
+        return math.hypot(x - t * dx, y - t * dy)
+
+    def _douglas_peucker_window(self, segment, window):
+        lon, lat = segment.lon, segment.lat
+        kx = math.cos(math.radians(lat[window[0]]))
+        xs = [lon[i] * kx for i in window]
+        ys = [lat[i] for i in window]
+        tolerance = self.tolerance / METRES_PER_DEGREE
+        keep = bytearray(len(window))
+        keep[0] = keep[-1] = 1
+        stack = [(0, len(window) - 1)]
+        while stack:
+            a, b = stack.pop()
+            if b - a < 2:
+                continue
+            ax, ay = xs[a], ys[a]
+            dx, dy = xs[b] - ax, ys[b] - ay
+            chord = math.hypot(dx, dy)
+            # distances to the line (a, b), times the chord length
+            c = ay * dx - ax * dy
+            distances = [abs(x * dy - y * dx + c) for x, y in zip(xs[a + 1:b], ys[a + 1:b])]
+            farthest = max(distances)
+            if farthest <= tolerance * chord:
+                # close to the line: only points beyond the ends of the chord can be far
+                between = list(zip(xs[a + 1:b], ys[a + 1:b]))
+                dots = [(x - ax) * dx + (y - ay) * dy for x, y in between]
+                if chord and min(dots) >= 0 and max(dots) <= chord * chord:
+                    continue
+                distances = [self._to_chord(x - ax, y - ay, dx, dy) for x, y in between]
+                farthest = max(distances)
+                if farthest <= tolerance:
+                    continue
+            i = a + 1 + distances.index(farthest)
+            keep[i] = 1
+            stack.append((a, i))
+            stack.append((i, b))
+        return array('q', compress(window, keep))
+
+
+class TrackStatistics(object):
+    '''
+    Length, elevation and time statistics of a track, over its segments as
+    they are written (after simplification or merging), in windows of
+    window points, column by column (map() over the columns, no loop per
+    point in Python):
+    - length: sum of the steps, measured in a local equirectangular
+      projection (the scale of longitudes updated every cosine_points
+      points), or by haversine for steps longer than long_step metres,
+    - length_3d: the same with the elevation change of each step
+      (the header's "length due to elevation"),
+    - elevation_gain, elevation_loss: sums of the changes between
+      successive known elevations (unsmoothed),
+    - duration: time from the first to the last point of each segment,
+    - moving_time: time of the steps faster than moving_speed (m/s),
+    - max_speed (m/s), over steps with increasing times.
+    as_dict() gives the totals with the same values per segment.
+    '''
+    window = 4096
+    cosine_points = 16
+    long_step = 1000.0
+    FIELDS = ('points', 'length', 'length_3d', 'elevation_gain', 'elevation_loss', 'duration',
+              'moving_time', 'max_speed')
+    # header field of a .trk (version <= 3) -> statistic
+    HEADER = {'number_of_locations': 'points', 'number_of_segments': 'segments',
+              'total_track_length': 'length', 'total_track_length_due_to_elevation': 'length_3d',
+              'total_track_elevation_gain': 'elevation_gain', 'total_track_time': 'duration'}
+
+    def __init__(self, moving_speed=0.5, stats=None):
+        self.moving_speed = float(moving_speed)
+        self.stats = stats
+        self.per_segment = []
+        self.current = None
+
+    def segments(self, segments):
+        for segment in segments:
+            self.add(segment)
+            yield segment
+
+    @timed('statistics')
+    def add(self, segment, new=True):
+        '''
+        Account for segment, or with new=False for the next points of the
+        last segment.
+        '''
+        if new or self.current is None:
+            self.current = dict.fromkeys(self.FIELDS, 0)
+            self.current.update(start=None, end=None)
+            self.per_segment.append(self.current)
+            self.last = None        # last point: lon, lat, alt, ts
+            self.last_alt = None    # last known elevation
+        for start in range(0, len(segment), self.window):
+            end = start + self.window
+            self._window(segment.lon[start:end], segment.lat[start:end], segment.alt[start:end],
+                         segment.ts[start:end])
+
+    def _window(self, lon, lat, alt, ts):
+        current = self.current
+        current['points'] += len(ts)
+        times = (ts[0], ts[-1]) if ts[0] == ts[0] and ts[-1] == ts[-1] else [t for t in ts if t == t]
+        if times:
+            if current['start'] is None:
+                current['start'] = times[0]
+            current['end'] = times[-1]
+        if self.last is not None:
+            # steps from the last point of the previous window
+            lon, lat, alt, ts = [array('d', [value]) + column
+                                 for value, column in zip(self.last, (lon, lat, alt, ts))]
+        self.last = (lon[-1], lat[-1], alt[-1], ts[-1])
+        if len(ts) < 2:
+            if alt[-1] == alt[-1]:
+                self.last_alt = alt[-1]
+            return
+
+        # cosine of the latitude of every cosine_points-th point, for the steps from it to the next
+        cosines = chain.from_iterable(map(repeat, map(math.cos, map(math.radians, lat[::self.cosine_points])),
+                                          repeat(self.cosine_points)))
+        steps = list(map(mul, map(math.hypot, map(mul, map(sub, lon[1:], lon), cosines),
+                                  map(sub, lat[1:], lat)), repeat(METRES_PER_DEGREE)))
+        if max(steps) > self.long_step:
+            for i, step in enumerate(steps):
+                if step > self.long_step:
+                    steps[i] = haversine(lon[i], lat[i], lon[i + 1], lat[i + 1])
+        current['length'] += sum(steps)
+
+        climbs = list(map(sub, alt[1:], alt))
+        climb = sum(climbs)
+        if climb == climb:
+            changes = climbs
+        else:
+            # unknown elevations: no change over the step, gain and loss between known ones
+            climbs = [value if value == value else 0.0 for value in climbs]
+            heights = array('d', [value for value in alt if value == value])
+            if alt[0] != alt[0] and self.last_alt is not None:
+                heights.insert(0, self.last_alt)
+            changes = list(map(sub, heights[1:], heights))
+            climb = sum(changes)
+            if heights:
+                self.last_alt = heights[-1]
+        if alt[-1] == alt[-1]:
+            self.last_alt = alt[-1]
+        current['length_3d'] += sum(map(math.hypot, steps, climbs))
+        # gain from the sum of the absolute changes, one pass instead of filtering the positive ones
+        gain = (sum(map(abs, changes)) + climb) / 2
+        current['elevation_gain'] += gain
+        current['elevation_loss'] += gain - climb
+
+        durations = list(map(sub, ts[1:], ts))
+        elapsed = sum(durations)
+        if elapsed != elapsed or min(durations) <= 0:
+            # repeated, unknown or decreasing times: only steps forward in time
+            forward = list(map(lt, repeat(0.0), durations))
+            steps = list(compress(steps, forward))
+            durations = list(compress(durations, forward))
+            if not durations:
+                return
+        speeds = list(map(truediv, steps, durations))
+        current['moving_time'] += sum(compress(durations, map(le, repeat(self.moving_speed), speeds)))
+        current['max_speed'] = max(current['max_speed'], max(speeds))
+
+    def as_dict(self):
+        segments = []
+        for current in self.per_segment:
+            segment = dict((name, current[name]) for name in self.FIELDS)
+            if current['start'] is not None:
+                segment['duration'] = current['end'] - current['start']
+            segment['start'] = _isotime(current['start'])
+            segment['end'] = _isotime(current['end'])
+            segments.append(segment)
+        result = dict((name, sum(s[name] for s in segments)) for name in self.FIELDS)
+        result['max_speed'] = max([s['max_speed'] for s in segments] or [0])
+        result['average_moving_speed'] = result['length'] / result['moving_time'] if result['moving_time'] else 0.0
+        result['segments'] = len(segments)
+        result['per_segment'] = segments
+        return result
+
+    def validate(self, header, tolerance=0.01):
+        '''
+        Compare the statistics with the header fields (as given by
+        alp2gpx.info()): {field: {header, computed, difference, ok}}, ok
+        when within tolerance (relative) or 1 unit.
+        '''
+        computed = self.as_dict()
+        result = {}
+        for field, name in sorted(self.HEADER.items()):
+            if header.get(field) is None:
+                continue
+            difference = computed[name] - header[field]
+            result[field] = {'header': header[field], 'computed': computed[name], 'difference': difference,
+                             'ok': abs(difference) <= max(1, tolerance * abs(header[field]))}
+        return result
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    # great circle distance (m) between two points given in degrees
+    lon1, lat1, lon2, lat2 = map(math.radians, (lon1, lat1, lon2, lat2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371008.8 * math.asin(math.sqrt(min(1.0, a)))
+
+
+def escape(text):
+    # XML character data (xml.sax.saxutils.escape, without its imports)
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def quoteattr(text):
+    # XML attribute value, with its double quotes (xml.sax.saxutils.quoteattr, likewise)
+    return '"%s"' % escape(text).replace('"', '&quot;').replace('\n', '&#10;').replace(
+        '\r', '&#13;').replace('\t', '&#9;')
+
+
+class TimeFormatter(object):
+    '''
+    ISO 8601 (UTC) text of a whole column of timestamps (s): the date is
+    formatted once per day, the time of day comes from integer arithmetic
+    and lookup tables. Seconds are truncated like datetime.utcfromtimestamp
+    (int(ts)); with milliseconds the time is rounded to the millisecond.
+    Missing (NaN) and out of range timestamps give None.
+    '''
+    MINUTES = ['%02d:%02d:' % divmod(m, 60) for m in range(1440)]
+    SECONDS = ['%02dZ' % s for s in range(60)]
+
+    def __init__(self, milliseconds=False):
+        self.milliseconds = milliseconds
+        self.days = {}
+
+    def _day(self, day):
+        result = datetime.utcfromtimestamp(day * 86400).strftime('%Y-%m-%dT')
+        self.days[day] = result
+        return result
+
+    def format(self, column):
+        try:
+            return self._format(column)
+        except (ValueError, OverflowError, OSError):
+            # the column has timestamps without a date: one at a time
+            return [self._time(ts) for ts in column]
+
+    def _time(self, ts):
+        try:
+            return self._format([ts])[0]
+        except (ValueError, OverflowError, OSError):
+            return None
+
+    def _format(self, column):
+        days, minutes, seconds = self.days, self.MINUTES, self.SECONDS
+        result = []
+        append = result.append
+        if not self.milliseconds:
+            for ts in column:
+                day, second = divmod(int(ts), 86400)
+                minute, second = divmod(second, 60)
+                append((days.get(day) or self._day(day)) + minutes[minute] + seconds[second])
+        else:
+            for ts in column:
+                second, millisecond = divmod(int(round(ts * 1000)), 1000)
+                day, second = divmod(second, 86400)
+                minute, second = divmod(second, 60)
+                append('%s%s%02d.%03dZ' % (days.get(day) or self._day(day), minutes[minute],
+                                           second, millisecond))
+        return result
+
+
+class OutputWriter(object):
+    '''
+    Base of the streaming output writers: begin(name, waypoints), then
+    route(name, points) for each route, then for each Segment as it is
+    decoded segment(name, segment), or
+    begin_segment(name), write_points(segment) for each part of it and
+    end_segment(), then end(). Only the points being written are held in
+    memory; text formats are emitted in chunks of chunk_points points,
+    formatted column by column (see TimeFormatter). precision and
+    ele_precision give the number of decimals of coordinates and
+    elevations (default: str(float)), milliseconds keeps the sub-second
+    part of (version 4) timestamps. statistics, when set (to
+    TrackStatistics.as_dict()) before end(), is written by the formats
+    having a place for it. An output path is written to path.tmp, renamed
+    by end(): after a failure, abort() removes it and no truncated output
+    is left.
+    '''
+    extension = None
+    media_type = 'application/octet-stream'
+    chunk_points = 4096
+    statistics = None
+
+    def __init__(self, output, precision=None, ele_precision=None, milliseconds=False):
+        self.path = None
+        if hasattr(output, 'write'):
+            self.file, self.owned = output, False
+        else:
+            self.path = output
+            self.file, self.owned = open(output + '.tmp', 'wb'), True
+        self.points = 0
+        self.bytes = 0
+        self.coordinate = str if precision is None else ('%%.%df' % precision).__mod__
+        self.elevation = str if ele_precision is None else ('%%.%df' % ele_precision).__mod__
+        self.times = TimeFormatter(milliseconds)
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        self.bytes += len(data)
+        self.file.write(data)
+
+    def _optional(self, column, template='%s', format=str):
+        # '' for missing (NaN) values
+        return [template % format(value) if value == value else '' for value in column]
+
+    def begin(self, name, waypoints):
+        pass
+
+    def route(self, name, points):
+        # formats without routes: the route points (waypoints) as a segment
+        segment = Segment()
+        for point in points:
+            segment.append(point['location'])
+        self.segment(name, segment)
+
+    def segment(self, name, segment):
+        self.begin_segment(name)
+        self.write_points(segment)
+        self.end_segment()
+
+    def begin_segment(self, name):
+        pass
+
+    def write_points(self, segment):
+        raise NotImplementedError
+
+    def end_segment(self):
+        pass
+
+    def end(self):
+        if self.owned:
+            self.file.close()
+            os.replace(self.path + '.tmp', self.path)
+        else:
+            self.file.flush()
+
+    def abort(self):
+        # the conversion failed: the temporary output is removed (a file
+        # object given is left as written)
+        if self.owned and not self.file.closed:
+            self.file.close()
+            try:
+                os.unlink(self.path + '.tmp')
+            except OSError:
+                pass
+
+
+class GpxWriter(OutputWriter):
+    '''
+    GPX 1.1 document: waypoints, routes, then one <trk> per segment. With
+    the default options the output matches what ElementTree used to produce.
+    '''
+    extension = '.gpx'
+    media_type = 'application/gpx+xml'
+
+    def begin(self, name, waypoints):
+        self._write("<?xml version='1.0' encoding='utf-8'?>\n"
+                    '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1" creator="Alp2gpx">\n'
+                    '<metadata>\n'
+                    '<desc>%s</desc>\n'
+                    '<link href="https://github.com/jachetto/alp2gpx" />\n'
+                    '</metadata>\n' % escape(name))
+        for wp in waypoints:
+            location = wp['location']
+            text = '<wpt lat="%s" lon="%s">' % (self.coordinate(location['lat']), self.coordinate(location['lon']))
+            if location['alt'] is not None:
+                text += '<ele>%s</ele>' % self.elevation(location['alt'])
+            text += '<name>%s</name></wpt>' % escape(wp['meta'].get('name', ''))
+            self._write(text)
+
+    def route(self, name, points):
+        self._write('<rte>\n<name>%s</name>\n' % escape(name))
+        for point in points:
+            location = point['location']
+            text = '<rtept lat="%s" lon="%s">' % (self.coordinate(location['lat']), self.coordinate(location['lon']))
+            if location['alt'] is not None:
+                text += '<ele>%s</ele>' % self.elevation(location['alt'])
+            text += '<name>%s</name></rtept>\n' % escape(point['meta'].get('name', ''))
+            self._write(text)
+        self._write('</rte>\n')
+        self.points += len(points)
+
+    def begin_segment(self, name):
+        self._write('<trk>\n<name>%s</name>\n<trkseg>\n' % escape(name))
+
+    def write_points(self, segment):
+        for start in range(0, len(segment), self.chunk_points):
+            end = start + self.chunk_points
+            lats = map(self.coordinate, segment.lat[start:end])
+            lons = map(self.coordinate, segment.lon[start:end])
+            # no <ele> for missing (NaN) heights
+            eles = self._optional(segment.alt[start:end], '<ele>%s</ele>\n', self.elevation)
+            times = self.times.format(segment.ts[start:end])
+            template = '<trkpt lat="%s" lon="%s">\n%s<time>%s</time>\n</trkpt>\n'
+            if None in times:
+                # no <time> for points without one
+                template = '<trkpt lat="%s" lon="%s">\n%s%s</trkpt>\n'
+                times = ['' if t is None else '<time>%s</time>\n' % t for t in times]
+            self._write(''.join(map(template.__mod__, zip(lats, lons, eles, times))))
+        self.points += len(segment)
+
+    def end_segment(self):
+        self._write('</trkseg>\n</trk>\n')
+
+    def _attributes(self, values):
+        return ''.join(' %s=%s' % (name, '"%s"' % round(value, 3) if isinstance(value, float)
+                                   else quoteattr(str(value)))
+                       for name, value in values.items() if value is not None)
+
+    def end(self):
+        if self.statistics:
+            # GPX extensions, in the alp2gpx namespace
+            self._write('<extensions>\n<statistics xmlns="https://github.com/jachetto/alp2gpx"%s>\n' %
+                        self._attributes(dict((name, value) for name, value in self.statistics.items()
+                                              if name != 'per_segment')))
+            for segment in self.statistics['per_segment']:
+                self._write('<segment%s />\n' % self._attributes(segment))
+            self._write('</statistics>\n</extensions>\n')
+        self._write('</gpx>')
+        OutputWriter.end(self)
+
+
+class GeoJsonWriter(OutputWriter):
+    '''
+    GeoJSON FeatureCollection: a Point feature per waypoint and a
+    LineString feature per segment, [lon, lat(, ele)] coordinates with the
+    times of the points in properties.coordTimes. The times follow the
+    coordinates, they are spooled (to a temporary file past spool_size
+    bytes) until the segment ends.
+    '''
+    extension = '.geojson'
+    media_type = 'application/geo+json'
+    spool_size = 16 << 20
+
+    def begin(self, name, waypoints):
+        self._write('{"type": "FeatureCollection", "name": %s, "features": [' % json.dumps(name))
+        self.features = 0
+        for wp in waypoints:
+            location = wp['location']
+            coordinates = [self.coordinate(location['lon']), self.coordinate(location['lat'])]
+            if location['alt'] is not None:
+                coordinates.append(self.elevation(location['alt']))
+            properties = {'name': wp['meta'].get('name', '')}
+            if location['ts'] is not None and self.times.format([location['ts']])[0]:
+                properties['time'] = self.times.format([location['ts']])[0]
+            # the coordinates formatted as the points of the segments
+            self._feature('{"type": "Feature", "properties": %s, "geometry": {"type": "Point", '
+                          '"coordinates": [%s]}}' % (json.dumps(properties), ', '.join(coordinates)))
+
+    def _feature(self, text):
+        self._write((',\n' if self.features else '\n') + text)
+        self.features += 1
+
+    def begin_segment(self, name):
+        import tempfile
+        self._feature('{"type": "Feature", "geometry": {"type": "LineString", "coordinates": [')
+        self.name = name
+        self.spool = tempfile.SpooledTemporaryFile(self.spool_size, 'w+')
+        self.separator = ''
+
+    def write_points(self, segment):
+        for start in range(0, len(segment), self.chunk_points):
+            end = start + self.chunk_points
+            self._write(self.separator + ','.join(map('[%s,%s%s]'.__mod__, zip(
+                map(self.coordinate, segment.lon[start:end]), map(self.coordinate, segment.lat[start:end]),
+                self._optional(segment.alt[start:end], ',%s', self.elevation)))))
+            times = self.times.format(segment.ts[start:end])
+            if None in times:
+                times = ['null' if t is None else '"%s"' % t for t in times]
+            else:
+                times = map('"%s"'.__mod__, times)
+            self.spool.write(self.separator + ','.join(times))
+            self.separator = ','
+        self.points += len(segment)
+
+    def end_segment(self):
+        self._write(']}, "properties": {"name": %s, "coordTimes": [' % json.dumps(self.name))
+        self.spool.seek(0)
+        for text in iter(lambda: self.spool.read(1 << 20), ''):
+            self._write(text)
+        self.spool.close()
+        self._write(']}}')
+
+    def end(self):
+        if self.statistics:
+            # a foreign member of the FeatureCollection
+            self._write('\n], "statistics": %s}\n' % json.dumps(self.statistics))
+        else:
+            self._write('\n]}\n')
+        OutputWriter.end(self)
+
+
+class CsvWriter(OutputWriter):
+    '''
+    CSV, one row per point: segment number (empty for waypoints), time,
+    lat, lon, ele, accuracy, pressure and name (waypoints only), empty
+    fields for missing values.
+    '''
+    extension = '.csv'
+    media_type = 'text/csv'
+    # accuracy in whole metres as recorded, pressure to its resolution
+    accuracy_format = '%d'
+    pressure_format = '%.3f'
+
+    def begin(self, name, waypoints):
+        self._write('segment,time,lat,lon,ele,acc,bar,name\n')
+        self.segments = 0
+        for wp in waypoints:
+            location = wp['location']
+            row = ['', (self.times.format([location['ts']])[0] or '') if location['ts'] is not None else '',
+                   self.coordinate(location['lat']), self.coordinate(location['lon'])]
+            row.append('' if location['alt'] is None else self.elevation(location['alt']))
+            row.append('' if location['acc'] is None else self.accuracy_format % location['acc'])
+            row.append('' if location['bar'] is None else self.pressure_format % location['bar'])
+            wpname = wp['meta'].get('name', '')
+            if any(c in wpname for c in ',"\r\n'):
+                wpname = '"%s"' % wpname.replace('"', '""')
+            self._write(','.join(row + [wpname]) + '\n')
+
+    def write_points(self, segment):
+        template = '%d,%%s,%%s,%%s,%%s,%%s,%%s,\n' % self.segments
+        for start in range(0, len(segment), self.chunk_points):
+            end = start + self.chunk_points
+            times = self.times.format(segment.ts[start:end])
+            if None in times:
+                times = [t or '' for t in times]
+            self._write(''.join(map(template.__mod__, zip(
+                times,
+                map(self.coordinate, segment.lat[start:end]), map(self.coordinate, segment.lon[start:end]),
+                self._optional(segment.alt[start:end], format=self.elevation),
+                self._optional(segment.acc[start:end], format=self.accuracy_format.__mod__),
+                self._optional(segment.bar[start:end], format=self.pressure_format.__mod__)))))
+        self.points += len(segment)
+
+    def end_segment(self):
+        self.segments += 1
+
+
+def npy_header(descr, shape):
+    # .npy format 1.0 header, the data following it aligned on 64 bytes
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': %r, }" % (descr, shape)
+    header += ' ' * (-(10 + len(header) + 1) % 64) + '\n'
+    return b'\x93NUMPY\x01\x00' + pack('<H', len(header)) + header.encode('latin1')
+
+
+class NpzWriter(OutputWriter):
+    '''
+    NumPy .npz archive (numpy.load, no parsing), stored uncompressed like
+    numpy.savez: per segment n one array of doubles per column, lon_n,
+    lat_n, alt_n, ts_n (s), acc_n and bar_n, NaN for missing values; the
+    waypoints as wpt_lon, wpt_lat, wpt_alt, wpt_ts and wpt_name. Values are
+    the decoded doubles, the precision options do not apply. A segment
+    written in parts is spooled to temporary files, the .npy header
+    giving its length.
+    '''
+    extension = '.npz'
+    media_type = 'application/zip'
+    DOUBLE = ('<' if sys.byteorder == 'little' else '>') + 'f8'
+
+    def begin(self, name, waypoints):
+        try:
+            self.start = self.file.tell()
+        except (AttributeError, OSError):
+            self.start = None
+        self.zip = zipfile.ZipFile(self.file, 'w', zipfile.ZIP_STORED)
+        self.segments = 0
+        for key in ('lon', 'lat', 'alt', 'ts'):
+            column = array('d', (NAN if wp['location'][key] is None else wp['location'][key]
+                                 for wp in waypoints))
+            self._array('wpt_' + key, self.DOUBLE, len(column), [memoryview(column).cast('B')])
+        names = [wp['meta'].get('name', '') for wp in waypoints]
+        width = max([1] + [len(n) for n in names])
+        self._array('wpt_name', '<U%d' % width, len(names),
+                    [b''.join(n.ljust(width, '\0').encode('utf-32-le') for n in names)])
+
+    def _array(self, name, descr, length, parts, itemsize=8):
+        # parts: bytes-like objects of the data
+        header = npy_header(descr, (length,))
+        size = len(header) + length * itemsize
+        with self.zip.open(name + '.npy', 'w', force_zip64=size > 0x7fffffff) as f:
+            f.write(header)
+            for data in parts:
+                f.write(data)
+
+    def segment(self, name, segment):
+        # a whole segment: written directly from its columns
+        for key in LOCATION_COLUMNS:
+            column = getattr(segment, key)
+            self._array('%s_%d' % (key, self.segments), self.DOUBLE, len(column),
+                        [memoryview(column).cast('B')])
+        self.segments += 1
+        self.points += len(segment)
+
+    def begin_segment(self, name):
+        import tempfile
+        self.spools = dict((key, tempfile.TemporaryFile()) for key in LOCATION_COLUMNS)
+        self.spooled = 0
+
+    def write_points(self, segment):
+        for key in LOCATION_COLUMNS:
+            self.spools[key].write(memoryview(getattr(segment, key)).cast('B'))
+        self.spooled += len(segment)
+        self.points += len(segment)
+
+    def end_segment(self):
+        for key in LOCATION_COLUMNS:
+            spool = self.spools[key]
+            spool.seek(0)
+            self._array('%s_%d' % (key, self.segments), self.DOUBLE, self.spooled,
+                        iter(lambda: spool.read(1 << 20), b''))
+            spool.close()
+        self.segments += 1
+
+    def abort(self):
+        try:
+            self.zip.close()
+        except (AttributeError, ValueError, OSError):
+            pass    # not begun, or a member still open
+        OutputWriter.abort(self)
+
+    def end(self):
+        self.zip.close()
+        if self.start is not None:
+            self.bytes = self.file.tell() - self.start
+        OutputWriter.end(self)
+
+
+# output formats (--format)
+WRITERS = {'gpx': GpxWriter, 'geojson': GeoJsonWriter, 'csv': CsvWriter, 'npz': NpzWriter}
+# keyword arguments taken by every writer
+WRITER_OPTIONS = ('precision', 'ele_precision', 'milliseconds')
+
+
+# .trk header fields, by accessor name (time_of_first_location aside)
+HEADER_FIELDS = ('number_of_locations', 'number_of_segments', 'number_of_waypoints',
+                 'longitude_of_first_location', 'latitude_of_first_location',
+                 'total_track_length', 'total_track_length_due_to_elevation',
+                 'total_track_elevation_gain', 'total_track_time')
+
+
+def _jsonable(value):
+    # {Metadata} values as JSON: raw and bool entries are read as bytes
+    if isinstance(value, bytes):
+        return value.decode('latin-1')
+    return value
+
+
+class LdkIndex(object):
+    '''
+    Offsets of the nodes and data entries of an .ldk archive: for each
+    entry its folder path, uuid, type, total size and the (offset, size)
+    of every chained data block, so an entry can be read without walking
+    the node tree. Cached in a sidecar JSON file, valid while the archive
+    fingerprint (size, mtime, content hash) matches; archives in memory
+    (archive None) are not cached.
+    '''
+    suffix = '.alp2gpx-index.json'
+
+    def __init__(self, archive):
+        self.archive = archive
+        self.path = archive + self.suffix if archive is not None else None
+        self.nodes = []
+        self.entries = []
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        # a damaged or foreign sidecar is not an error: the index is rebuilt
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+            stamp = cached.get('fingerprint', {})
+            current = fingerprint(self.archive, hashed=False)
+            if cached.get('converter') != __version__ or current['size'] != stamp.get('size'):
+                return False
+            if current['mtime_ns'] != stamp.get('mtime_ns') and \
+                    fingerprint(self.archive)['sha256'] != stamp.get('sha256'):
+                return False
+            nodes, entries = cached['nodes'], cached['entries']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return False
+        if not isinstance(nodes, list) or not isinstance(entries, list):
+            return False
+        self.nodes = nodes
+        self.entries = entries
+        return True
+
+    def save(self):
+        # False when the sidecar cannot be written (a read-only store): the
+        # index is then used without being cached, as for archives in memory
+        cached = {'converter': __version__, 'fingerprint': fingerprint(self.archive),
+                  'nodes': self.nodes, 'entries': self.entries}
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp, self.path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return False
+        return True
+
+    def find(self, selector):
+        # entries matching a path or a uuid (hexadecimal, as listed)
+        try:
+            uuid = int(selector, 16)
+        except ValueError:
+            uuid = None
+        return [entry for entry in self.entries
+                if entry['path'] == selector or entry['uuid'] == uuid]
+
 
 class alp2gpx(object):
-    inputfile, outputfile = None, None
-    fileVersion, headerSize = None, None
-    metadata, waypoints, segments = None, None, None 
-    
-    def __init__(self, inputfile, outputfile):
-        self.inputfile = open(inputfile, "rb")
+
+    def __init__(self, inputfile, outputfile, convert=True, stats=None, options=None):
+        '''
+        Open inputfile and convert it to outputfile; with convert=False
+        (lazy mode) the input is only opened, nothing is parsed until the
+        accessors, info(), tracks() or ldk_index() are used. inputfile is a
+        path, a buffer (bytes, memoryview) or a binary file object,
+        outputfile a path or a writable binary file object. stats (True or
+        a Stats to accumulate into) records counters and phase timings in
+        self.stats. options: 'format' (a WRITERS key, default gpx),
+        'simplify' (keyword arguments of Simplifier, to reduce the points
+        before writing them), 'statistics' (True: TrackStatistics of the
+        points written, in self.statistics and in the output), 'jobs'
+        (processes decoding the segments of a .trk path in parallel),
+        'split' (each entry of an .ldk to its own file, outputfile being a
+        directory, see parse_ldk), 'partial' (decode damaged inputs as far
+        as possible, see _damaged) and keyword arguments of the writer
+        (precision, ele_precision, milliseconds).
+        All the state is held by the instance: use one instance per
+        conversion, instances can work in parallel threads.
+        '''
+        self.options = options or {}
+        self.stats = Stats() if stats is True else stats or None
+        self.inputpath = inputfile if isinstance(inputfile, str) else None
+        self.inputfile = self._reader(inputfile)
         self.outputfile = outputfile
-        
-        ext = os.path.splitext(inputfile)[1]
-        if ext.lower() == '.trk':
+        self.fileVersion, self.headerSize = None, None
+        self.metadata, self.sumary, self.waypoints = None, None, None
+        self.track = None
+        self.points = 0     # track points written
+        self.removed = 0    # track points removed by the Simplifier
+        self.statistics = None
+        self.diagnostics = []   # damaged data skipped in partial mode
+        self.entry = None       # path of the .ldk entry being decoded
+        if convert:
+            self.convert()
+
+    def input_type(self):
+        '''
+        'trk' or 'ldk': from the file extension for a path, else from the
+        first int of the content (see TRK_MAGICS).
+        '''
+        if self.inputpath is not None:
+            return os.path.splitext(self.inputpath)[1].lower()[1:]
+        if self.inputfile.size >= 4 and self.inputfile.unpack_at(INT, 0)[0] in TRK_MAGICS:
+            return 'trk'
+        return 'ldk'
+
+    def convert(self):
+        kind = self.input_type()
+        if kind == 'trk':
             self.parse_trk()
-        elif ext.lower() == '.ldk':
+        elif kind == 'ldk':
             self.parse_ldk()
         else:
             print('File not supported yet')
-        
-    
+
+
+    def _reader(self, source):
+        if self.stats is None:
+            return Reader(source)
+        return CountingReader(source, self.stats)
+
+    def _damaged(self, field, e, entry=None, recovered=False):
+        '''
+        Damaged data found decoding field: raised as a FormatError (offset,
+        field, reason), or with options['partial'] recorded in
+        self.diagnostics as a dict of them (and the path of the .ldk entry,
+        whose offsets are relative to its data), the decoding going on with
+        what can still be read. recovered: the decoding already works
+        around it (a cycle cut, an entry skipped), recorded in both modes.
+        '''
+        if not isinstance(e, FormatError):
+            e = FormatError(self.inputfile.tell(), field, '%s: %s' % (type(e).__name__, e))
+        if not recovered and not self.options.get('partial'):
+            raise e
+        diagnostic = e.as_dict()
+        if entry or self.entry:
+            diagnostic['entry'] = entry or self.entry
+        self.diagnostics.append(diagnostic)
+
+    def _unsupported(self, entry):
+        # an .ldk entry of a type or version not supported, skipped
+        self._damaged('entry', FormatError(entry['offset'], 'entry', '%s entries not supported' % entry['type']),
+                      entry['path'], recovered=True)
+
+    def _count(self, field, count, item_size):
+        # a count just read, checked against the bytes left before anything
+        # is allocated for it: count items of at least item_size bytes. In
+        # partial mode, cut to what the bytes left can hold
+        left = self.inputfile.size - self.inputfile.tell()
+        if 0 <= count and count * item_size <= left:
+            return count
+        self._damaged(field, FormatError(self.inputfile.tell() - 4, field, '%d items of %d bytes or more, '
+                                         '%d bytes left' % (count, item_size, left)))
+        return max(0, min(count, left // item_size))
+
+    def _size(self, field, size, least=0):
+        # a size just read (of the data following it), checked against the bytes left
+        left = self.inputfile.size - self.inputfile.tell()
+        if not least <= size <= left:
+            raise FormatError(self.inputfile.tell() - 4, field, 'size %d, %d bytes left' % (size, left))
+        return size
+
     def _get_int(self):
-        result = self.inputfile.read(4)
-        return  unpack('>l', result)[0]
+        return self.inputfile.int32()
     
     def _get_double(self):
-        result = self.inputfile.read(8)
-        return  unpack('>d', result)[0]
+        return self.inputfile.double()
     
     def _get_coordinate(self):
         result = self._get_int() * 1e-7;
         return result
     
-    def _get_double(self):
-        result = self.inputfile.read(8)
-        return  unpack('>d', result)[0]
-    
     def _get_long(self):
-        result = self.inputfile.read(8)
-        return  unpack('>q', result)[0]
+        return self.inputfile.int64()
      
     def _get_timestamp(self):
         result = self._get_long() * 1e-3;
         return result
     
     def _get_string(self, size):
-        result = self.inputfile.read(size)
-        return result.decode('UTF-8')
+        return self.inputfile.string(size)
         
     def _get_raw(self, size):
         value = self.inputfile.read(size)
@@ -80,23 +1394,21 @@ class alp2gpx(object):
         return(value)
     
     def _get_int_raw(self):
-        size = self._get_int()
+        size = self._size('raw data', self._get_int())
         value = self.inputfile.read(size)
         result = base64.b64encode(value)
         return result
     
     def _get_bool(self):
-        result = self.inputfile.read(1)
-        return unpack('c', result)[0]
+        return self.inputfile.read(1).tobytes()
     
     def _get_pointer(self):
-        result = self.inputfile.read(8)
-        return unpack('>Q', result)[0]
+        return self.inputfile.pointer()
     
     
     def _get_height(self):
         result = self._get_int()
-        if result ==  -999999999:
+        if result == NO_HEIGHT:
             return None
         else:
             result *= 1e-3
@@ -107,24 +1419,29 @@ class alp2gpx(object):
     
     def _get_pressure(self):
         result = self._get_int()
-        if result ==  999999999:
+        if result == NO_PRESSURE:
             return None
         else:
             result *= 1e-3
         return result        
     
+    @timed('metadata')
     def _get_metadata(self, fileVersion):
         result = {}
         num_of_metaentries = self._get_int()
+        if not 0 <= num_of_metaentries * MIN_META_ENTRY <= self.inputfile.size - self.inputfile.tell():
+            raise FormatError(self.inputfile.tell() - 4, 'metadata', '%d entries' % num_of_metaentries)
         for entry in range(num_of_metaentries):
-            name_len = self._get_int()
+            name_len = self._size('metadata name', self._get_int())
             name = self._get_string(name_len)
             data_len = self._get_int()
+            if data_len < -4:
+                raise FormatError(self.inputfile.tell() - 4, 'metadata ' + name, 'unknown type %d' % data_len)
             if data_len == -1:  data = self._get_bool()
             if data_len == -2:  data = self._get_long()
             if data_len == -3:  data = self._get_double()
             if data_len == -4:  data = self._get_int_raw()
-            if data_len >= 0:  data = self._get_string(data_len)
+            if data_len >= 0:  data = self._get_string(self._size('metadata ' + name, data_len))
             result[name] = data
         if fileVersion == 3:
             nmeta_ext = self._get_int()
@@ -132,7 +1449,12 @@ class alp2gpx(object):
         return result
     
     def _get_location(self, segmentVersion):
+        if segmentVersion not in MIN_LOCATION:
+            raise FormatError(self.inputfile.tell(), 'location', 'unknown segment version %r' % segmentVersion)
         size = self._get_int()
+        end = self.inputfile.tell() + size
+        if size < MIN_LOCATION[segmentVersion] - 4 or end > self.inputfile.size:
+            self._size('location', size, MIN_LOCATION[segmentVersion] - 4)
         lon = self._get_coordinate()
         lat = self._get_coordinate()
         if segmentVersion <= 3: 
@@ -148,44 +1470,158 @@ class alp2gpx(object):
         
         elif segmentVersion == 4:
             size = size - 8     # count used items
-            acc,bar = None, None
+            alt, ts, acc, bar = None, None, None, None
             while size > 0:
                 # read name of data (e=elevation, ...)
-                name = self._get_string(1)
-                if name == "e":
+                name = self._get_raw(1).tobytes()
+                if name in LOCATION_FIELD_SIZES and size < LOCATION_FIELD_SIZES[name]:
+                    raise FormatError(self.inputfile.tell() - 1, 'location', 'field %s past the end of the record'
+                                      % name.decode())
+                if name == b"e":
                     # elevation
                     alt = self._get_height()
                     size = size - 5
                     # print("Altitude" , alt)
                     continue
-                if name == "t":
+                if name == b"t":
                     # timestamp
                     ts = self._get_timestamp()
                     size = size - 9
                     # print("Time" , ts)
                     continue
-                if name == "a":
+                if name == b"a":
                     # accuracy
                     acc = self._get_accuracy()
                     size = size - 5
                     # print("accuracy" , acc)
                     continue
-                if name == "p":
+                if name == b"p":
                     # pressure
                     bar = self._get_pressure()
                     size = size - 5
                     # print("pressure" , bar)
                     continue
-                
-        else:
-            print("Location format error")
-            exit()
-            
+                # unknown field of unknown size: skip the rest of the record
+                break
+
+        # next record (the fields of bigger version <= 3 records are skipped)
+        self.inputfile.seek(end)
         result = { 'lat': lat, 'lon': lon, 'alt': alt, 'ts': ts, 'acc': acc, 'bar': bar}
         return result
     
     
-    def _get_segment(self, segmentVersion):
+    def _get_fixed_locations(self, nlocations, meta=None):
+        # bulk decode of nlocations version <= 3 records sharing one size into
+        # a Segment; returns None (file position untouched) when sizes are mixed
+        start = self.inputfile.tell()
+        size = self._get_int()
+        record = LOCATION_RECORDS.get(size)
+        self.inputfile.seek(start)
+        if record is None:
+            return None
+        data = self.inputfile.read(record.size * nlocations)
+        if len(data) != record.size * nlocations:
+            self.inputfile.seek(start)
+            return None
+        fields = list(zip(*record.iter_unpack(data)))
+        sizes = fields[0]
+        if min(sizes) != size or max(sizes) != size:
+            self.inputfile.seek(start)
+            return None
+
+        result = Segment(meta,
+            lon=array('d', [v * 1e-7 for v in fields[1]]),
+            lat=array('d', [v * 1e-7 for v in fields[2]]),
+            alt=array('d', [NAN if v == NO_HEIGHT else v * 1e-3 for v in fields[3]]),
+            ts=array('d', [v * 1e-3 for v in fields[4]]))
+        if size > 20:
+            result.acc = array('d', fields[5])
+        else:
+            result.acc = array('d', [NAN]) * nlocations
+        if size > 24:
+            result.bar = array('d', [NAN if v == NO_PRESSURE else v * 1e-3 for v in fields[6]])
+        else:
+            result.bar = array('d', [NAN]) * nlocations
+        return result
+
+    def _tag_layout(self, offset):
+        # tags of the version 4 record at offset, None if it has an unknown
+        # tag or its fields do not add up to its size
+        buffer = self.inputfile.buffer
+        if offset + 4 > self.inputfile.size:
+            return None
+        end = offset + 4 + INT.unpack_from(buffer, offset)[0]
+        if end > self.inputfile.size:
+            return None
+        position = offset + 12
+        tags = []
+        while position < end:
+            tag = buffer[position]
+            if tag not in LOCATION_TAGS or tag in tags:
+                return None
+            tags.append(tag)
+            position += 1 + (8 if LOCATION_TAGS[tag][1] == 'q' else 4)
+        if position != end:
+            return None
+        return tuple(tags)
+
+    def _get_tagged_locations(self, nlocations, meta=None):
+        # version 4 records into a Segment: runs of records sharing a tag
+        # layout are unpacked in batches with the Struct compiled for it,
+        # batches growing while the layout holds; records the layout cannot
+        # describe go through _get_location
+        reader = self.inputfile
+        result = Segment(meta)
+        batch = 16
+        done = 0
+        while done < nlocations:
+            start = reader.tell()
+            tags = self._tag_layout(start)
+            count = 0
+            if tags is not None:
+                record, key, expected = tagged_record(tags)
+                count = min(batch, nlocations - done, (reader.size - start) // record.size)
+            if count == 0:
+                if not self._append_location(result, 4):
+                    break
+                done += 1
+                continue
+
+            rows = list(record.iter_unpack(reader.buffer[start:start + record.size * count]))
+            keys = list(map(key, rows))
+            if keys.count(expected) != count:
+                # the layout changes: keep the rows before
+                count = next(i for i, k in enumerate(keys) if k != expected)
+                rows = rows[:count]
+                batch = 16
+            else:
+                batch = min(2 * batch, 65536)
+
+            fields = list(zip(*rows))
+            result.lon.extend([v * 1e-7 for v in fields[1]])
+            result.lat.extend([v * 1e-7 for v in fields[2]])
+            present = set()
+            for i, tag in enumerate(tags):
+                name = LOCATION_TAGS[tag][0]
+                values = fields[4 + 2 * i]
+                if name == 'alt':
+                    values = [NAN if v == NO_HEIGHT else v * 1e-3 for v in values]
+                elif name == 'ts':
+                    values = [v * 1e-3 for v in values]
+                elif name == 'bar':
+                    values = [NAN if v == NO_PRESSURE else v * 1e-3 for v in values]
+                getattr(result, name).extend(values)
+                present.add(name)
+            for name in ('alt', 'ts', 'acc', 'bar'):
+                if name not in present:
+                    getattr(result, name).extend(array('d', [NAN]) * count)
+            reader.seek(start + record.size * count)
+            done += count
+        return result
+
+    def _get_segment_head(self, segmentVersion):
+        # {Segment} up to its locations: (metadata, number of locations)
+        meta = None
         if segmentVersion < 3:
             self._get_int()
         else:
@@ -194,198 +1630,619 @@ class alp2gpx(object):
                 self._get_int() # skip unknown int
                 self._get_int() # skip unknown int
         
-        nlocations = self._get_int()
+        nlocations = self._count('locations', self._get_int(), MIN_LOCATION[segmentVersion])
 #         print("Nb locations:" , nlocations)
-        result = []
-        for n in range(nlocations):
-            location = self._get_location(segmentVersion)
-            result.append(location)
+        return meta, nlocations
+
+    def _get_segment(self, segmentVersion):
+        meta, nlocations = self._get_segment_head(segmentVersion)
+        result = self._get_locations(segmentVersion, nlocations, meta)
+        if self.stats is not None:
+            self.stats.segments += 1
+            self.stats.points += len(result)
         return result
+
+    def _get_segment_parts(self, segmentVersion, part_points):
+        # the {Segment} as (new, Segment) parts of at most part_points
+        # locations, new for the first one (always given, even empty)
+        meta, nlocations = self._get_segment_head(segmentVersion)
+        if self.stats is not None:
+            self.stats.segments += 1
+        new = True
+        while new or nlocations > 0:
+            count = min(nlocations, part_points)
+            part = self._get_locations(segmentVersion, count, meta)
+            # in partial mode the reader is left at the end when no more
+            # locations can be found
+            nlocations = 0 if self.inputfile.tell() >= self.inputfile.size else nlocations - count
+            if self.stats is not None:
+                self.stats.points += len(part)
+            self.inputfile.release(self.inputfile.tell())
+            yield new, part
+            new = False
+
+    @timed('locations')
+    def _get_locations(self, segmentVersion, nlocations, meta=None):
+        # nlocations {Location} records from the current position into a Segment
+        result = None
+        if segmentVersion <= 3 and nlocations > 0:
+            result = self._get_fixed_locations(nlocations, meta)
+        elif segmentVersion == 4:
+            result = self._get_tagged_locations(nlocations, meta)
+
+        if result is None:
+            # one record at a time (mixed record sizes); a damaged record is
+            # decoded again by _append_location, which reports and skips it
+            result = Segment(meta)
+            reader, append, get_location = self.inputfile, result.append, self._get_location
+            for n in range(nlocations):
+                start = reader.tell()
+                try:
+                    append(get_location(segmentVersion))
+                except DECODE_ERRORS:
+                    reader.seek(start)
+                    if not self._append_location(result, segmentVersion):
+                        break
+        return result
+
+    def _append_location(self, segment, segmentVersion):
+        # append the next {Location} to segment. In partial mode a damaged
+        # record is reported and skipped up to the next plausible record;
+        # False when there is none (the reader is then left at the end)
+        start = self.inputfile.tell()
+        try:
+            segment.append(self._get_location(segmentVersion))
+            return True
+        except DECODE_ERRORS as e:
+            self.inputfile.seek(start)
+            self._damaged('location', e)
+        offset = self._resync(segmentVersion, start + 1)
+        self.inputfile.seek(self.inputfile.size if offset is None else offset)
+        return offset is not None
+
+    def _plausible(self, segmentVersion, offset):
+        # size of the {Location} record at offset, None unless it looks like
+        # one: a valid layout, coordinates in range
+        reader = self.inputfile
+        if offset + 12 > reader.size:
+            return None
+        size, lon, lat = reader.unpack_at(LOCATION_START, offset)
+        if abs(lon) > 1800000000 or abs(lat) > 900000000:
+            return None
+        if segmentVersion <= 3:
+            return size if size in LOCATION_RECORDS and offset + 4 + size <= reader.size else None
+        return size if self._tag_layout(offset) is not None else None
+
+    def _resync(self, segmentVersion, offset):
+        # offset of the first plausible {Location} record from offset on (in
+        # RESYNC_WINDOW bytes), followed by another one or by the end of
+        # the data, None if there is none
+        reader = self.inputfile
+        for offset in range(offset, min(offset + RESYNC_WINDOW, reader.size - 11)):
+            size = self._plausible(segmentVersion, offset)
+            if size is not None and (offset + 4 + size == reader.size or
+                                     self._plausible(segmentVersion, offset + 4 + size) is not None):
+                return offset
+        return None
+
+    def _skip_locations(self, nlocations, piece_points):
+        # (offset, count) pieces of at most piece_points of the nlocations
+        # {Location} records at the current position, left after them: the
+        # records are checked to share one size in one pass, else walked
+        # through their size fields
+        reader = self.inputfile
+        start = reader.tell()
+        if nlocations <= 0:
+            return []
+        size = reader.unpack_at(INT, start)[0]
+        end = start + (size + 4) * nlocations
+        if size >= 0 and end <= reader.size and \
+                set(Struct('>l%dx' % size).iter_unpack(reader.buffer[start:end])) == {(size,)}:
+            reader.seek(end)
+            return [(start + (size + 4) * i, min(piece_points, nlocations - i))
+                    for i in range(0, nlocations, piece_points)]
+        pieces = []
+        offset = start
+        for i in range(nlocations):
+            if i % piece_points == 0:
+                pieces.append((offset, min(piece_points, nlocations - i)))
+            size = reader.unpack_at(INT, offset)[0]
+            if not 8 <= size <= reader.size - offset - 4:
+                raise FormatError(offset, 'location', 'size %d, %d bytes left' % (size, reader.size - offset - 4))
+            offset += 4 + size
+        reader.seek(offset)
+        return pieces
+
+    @timed('prescan')
+    def segment_pieces(self, segmentVersion, piece_points=1 << 16):
+        '''
+        Pre-scan of the {Segments} (after the waypoints) without decoding
+        the locations: for each segment its metadata and the (offset,
+        count) of pieces of at most piece_points locations, each starting
+        on a record, so they can be decoded independently.
+        '''
+        layout = []
+        for s in range(self._count('segments', self._get_int(), MIN_SEGMENT)):
+            meta = None
+            if segmentVersion < 3:
+                self._get_int()
+            else:
+                meta = self._get_metadata(segmentVersion)
+                if segmentVersion == 4:
+                    self._get_int()
+                    self._get_int()
+            nlocations = self._count('locations', self._get_int(), MIN_LOCATION[segmentVersion])
+            layout.append((meta, self._skip_locations(nlocations, piece_points)))
+        return layout
+
+    def _iter_parallel_segments(self, segmentVersion, jobs, piece_points=1 << 16):
+        # the segments of segment_pieces() decoded by a pool of jobs processes
+        # mapping the input. The columns of a piece come back through a slot
+        # of a spool file mapped by all the processes, with 2 slots per
+        # process: at most that many pieces are decoded ahead of the caller
+        import tempfile
+        layout = self.segment_pieces(segmentVersion, piece_points)
+        queue = iter([piece for meta, pieces in layout for piece in pieces])
+        slots = 2 * jobs
+        slot_size = piece_points * 8 * len(LOCATION_COLUMNS)
+        handle, spool_path = tempfile.mkstemp(suffix='.alp2gpx-spool')
+        pool = spool = None
+        try:
+            os.ftruncate(handle, slots * slot_size)
+            spool = mmap.mmap(handle, slots * slot_size)
+            pool = multiprocessing.Pool(jobs, _open_decoder, (self.inputpath, segmentVersion, spool_path))
+
+            def submit(slot):
+                for offset, count in islice(queue, 1):
+                    pending.append((slot, count, pool.apply_async(_decode_piece, (offset, count, slot * slot_size))))
+
+            pending = deque()
+            for slot in range(slots):
+                submit(slot)
+            for meta, pieces in layout:
+                result = Segment(meta)
+                for piece in pieces:
+                    slot, count, decoded = pending.popleft()
+                    decoded.get()
+                    start = slot * slot_size
+                    for name in LOCATION_COLUMNS:
+                        getattr(result, name).frombytes(spool[start:start + 8 * count])
+                        start += 8 * count
+                    submit(slot)
+                if self.stats is not None:
+                    self.stats.segments += 1
+                    self.stats.points += len(result)
+                yield result
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            if spool is not None:
+                spool.close()
+            os.close(handle)
+            os.unlink(spool_path)
             
+    def _iter_located_segments(self, segmentVersion):
+        # (offset, Segment) of each segment of the {Segments}
+        for offset, new, segment in self._iter_located_parts(segmentVersion):
+            yield offset, segment
+
+    def _iter_located_parts(self, segmentVersion, part_points=None):
+        # (offset, new, Segment) of the segments of the {Segments}: whole
+        # (part_points None, new always True), or in parts of at most
+        # part_points locations, new for the first part of a segment, offset
+        # being that of the segment. In partial mode the segments end at the
+        # first one that cannot be read
+        try:
+            if self.inputfile.tell() >= self.inputfile.size:
+                raise FormatError(self.inputfile.tell(), 'segments', 'end of the data')
+            num_segments = self._count('segments', self._get_int(), MIN_SEGMENT)
+#             print("Nb segments:" , num_segments)
+            for s in range(num_segments):
+                offset = self.inputfile.tell()
+                if offset >= self.inputfile.size:
+                    raise FormatError(offset, 'segments', 'end of the data, %d of %d segments missing'
+                                      % (num_segments - s, num_segments))
+                if part_points is None:
+                    yield offset, True, self._get_segment(segmentVersion)
+                    continue
+                for new, part in self._get_segment_parts(segmentVersion, part_points):
+                    yield offset, new, part
+        except DECODE_ERRORS as e:
+            self._damaged('segment', e)
+
+    def _iter_segments(self, segmentVersion):
+        for offset, segment in self._iter_located_segments(segmentVersion):
+            yield segment
+
+    def _iter_segment_parts(self, segmentVersion, part_points=1 << 16):
+        # (new, Segment) parts of the segments, see _iter_located_parts
+        for offset, new, part in self._iter_located_parts(segmentVersion, part_points):
+            yield new, part
+
+    def segment_at(self, offset):
+        '''
+        The segment starting at offset (as given by _iter_located_segments),
+        after read_header().
+        '''
+        self.inputfile.seek(offset)
+        return self._get_segment(self.fileVersion)
+
     def _get_segments(self, segmentVersion):
-        num_segments = self._get_int()
-#         print("Nb segments:" , num_segments)
-        results = []
-        for s in range(num_segments):
-            segment = self._get_segment(segmentVersion)
-            results.append(segment)
-        return results
+        return list(self._iter_segments(segmentVersion))
             
             
+    @timed('waypoints')
     def _get_waypoints(self):
-        num_waypoints = self._get_int()
-#         print("Nb waypoints:" , num_waypoints)
+        # in partial mode the waypoints end at the first one that cannot be
+        # read, the reader being left at the end (nothing else can be found)
         result = []
-        for wp in range(num_waypoints):
-            meta = self._get_metadata(self.fileVersion)
-            location = self._get_location()
-            result.append({'meta': meta, 'location': location})
+        try:
+            num_waypoints = self._count('waypoints', self._get_int(), 4 + MIN_LOCATION[self.fileVersion])
+            if self.stats is not None:
+                self.stats.waypoints += num_waypoints
+#             print("Nb waypoints:" , num_waypoints)
+            for wp in range(num_waypoints):
+                meta = self._get_metadata(self.fileVersion)
+                location = self._get_location(self.fileVersion)
+                result.append({'meta': meta, 'location': location})
+        except DECODE_ERRORS as e:
+            self._damaged('waypoint', e)
+            self.inputfile.seek(self.inputfile.size)
         return result
         
-    def _get_additional_data(self, offset):
-        data = ''
-        magic_number = self._get_int()   
-        size = self._get_long()
-        add_offset = self._get_pointer()
-        add_data = self._get_raw(size)
-        data += add_data
-        if add_offset:
-            moreData = self._get_additional_data(add_offset)
-            data += moreData
-        return(data)
-            
-    def _get_node_data(self, node):
-        data = ''
-        self.inputfile.seek(node['offset'])
-        magic_number = self._get_int()   
+    def _get_data_blocks(self, offset):
+        # {NodeData}
+        # - int magic number of the node data (0x00105555)
+        # - int flags
+        # - long total size of the data
+        # - long size of the data in this block
+        # - pointer {NodeAdditionalData} next block of data (or 0)
+        # - raw data
+        # {NodeAdditionalData}
+        # - int magic number (0x00205555)
+        # - long size of the data in this block
+        # - pointer {NodeAdditionalData} next block of data (or 0)
+        # - raw data
+        # returns the (offset, size) of the raw data of each block, and the total
+        # size; the chain stops at a block already in it
+        self.inputfile.seek(offset)
+        magic_number = self._get_int()
         flags = self._get_int()
         total_size = self._get_long()
-        size = self._get_long()        
-        add_offset = self._get_pointer()    
-        data += self._get_raw(size)
-        
-        if add_offset:
-            data += self._get_additional_data(add_offset)
-        
+        size = self._get_long()
+        add_offset = self._get_pointer()
+        blocks = [self._data_block(offset, size)]
+        seen = {offset}
+        while add_offset:
+            if add_offset in seen:
+                self._damaged('data', FormatError(offset, 'data', 'chained block 0x%X seen before, chain cut'
+                                                  % add_offset), recovered=True)
+                break
+            seen.add(add_offset)
+            self.inputfile.seek(add_offset)
+            block = add_offset
+            magic_number = self._get_int()
+            size = self._get_long()
+            add_offset = self._get_pointer()
+            blocks.append(self._data_block(block, size))
+        return blocks, total_size
+
+    def _data_block(self, offset, size):
+        # (offset, size) of the raw data following the block header at offset
+        left = self.inputfile.size - self.inputfile.tell()
+        if not 0 <= size <= left:
+            raise FormatError(offset, 'data', 'block of %d bytes, %d bytes left' % (size, left))
+        return self.inputfile.tell(), size
+
+    def _get_data(self, blocks):
+        # raw data of an entry: a view of the archive when it is in one block,
+        # else copied once into a buffer of the total size
+        buffer = self.inputfile.buffer
+        if len(blocks) == 1:
+            offset, size = blocks[0]
+            return buffer[offset:offset + size]
+        data = bytearray(sum(size for offset, size in blocks))
+        position = 0
+        for offset, size in blocks:
+            data[position:position + size] = buffer[offset:offset + size]
+            position += size
         return data
-        
-    def _get_node(self, offset, path=None, uuid=None):
+
+    def _get_node_entries(self, offset):
+        # {NodeEntries}, as a list:
+        # - int magic number (0x00025555)
+        # - int number of entries (child, empty and data)
+        # - int number of child entries
+        # - int number of data entries
+        # - pointer {NodeEntries} additional entries (or 0)
+        # - {NodeEntry} child entries, empty entries, data entries
+        # or as a table:
+        # - int magic number (0x00045555)
+        # - int number of child entries
+        # - int number of data entries
+        # - {NodeEntry} child entries, data entries
+        # {NodeEntry}
+        # - pointer {Node} or {NodeData}
+        # - int uuid
+        # returns the (offset, uuid) of the child and data entries, following
+        # the additional entries (None when the magic number is unknown)
+        child_entries, data_entries = [], []
+        seen = set()
+        while offset:
+            if offset in seen:
+                self._damaged('entries', FormatError(offset, 'entries', 'seen before, list cut'), recovered=True)
+                break
+            seen.add(offset)
+            self.inputfile.seek(offset)
+            node_entries_magic = self._get_int()
+            if node_entries_magic == 0x00025555:
+                n_total = self._get_int()
+                n_child = self._get_int()
+                n_data = self._get_int()
+                add_offset = self._get_pointer()
+                n_empty = n_total - n_child - n_data
+            elif node_entries_magic == 0x00045555:
+                n_child = self._get_int()
+                n_data = self._get_int()
+                add_offset = 0
+                n_empty = 0
+            elif len(seen) == 1:
+                return None
+            else:
+                self._damaged('entries', FormatError(offset, 'entries', 'unknown magic number, list cut'),
+                              recovered=True)
+                break
+            if min(n_child, n_data, n_empty) < 0 or \
+                    (n_child + n_empty + n_data) * NODE_ENTRY > self.inputfile.size - self.inputfile.tell():
+                raise FormatError(offset, 'entries', '%d child, %d empty and %d data entries'
+                                  % (n_child, n_empty, n_data))
+            for child in range(n_child):
+                child_entries.append((self._get_pointer(), self._get_int()))
+            self.inputfile.seek(self.inputfile.tell() + n_empty * (8+4))
+            for x in range(n_data):
+                data_entries.append((self._get_pointer(), self._get_int()))
+            offset = add_offset
+        return child_entries, data_entries
+
+    def _get_node(self, offset, path, uuid):
         # {Node}
         # - int magic number of the node (0x00015555)
         # - int flags
         # - pointer {Metadata} position of node metadata
         # - double reserved
         # - {NodeEntries} entries of the nod
-        
+        # returns the node and its (child, data) entries (None if unknown)
+
+        if self.stats is not None:
+            self.stats.ldk_nodes += 1
         self.inputfile.seek(offset)
         magig_number_of_the_node = self._get_int()
         flags  = self._get_int()
         metadata_pointer = self._get_pointer()
-        node_entries = self._get_long()
-        
+        reserved = self._get_double()
+        node_entries = self.inputfile.tell()
+
         self.inputfile.seek(metadata_pointer+0x20)
         metadata = self._get_metadata(2)
-        self.inputfile.seek(node_entries)
-         
-        if path and not uuid:
-            path = '/'
-        elif uuid:
-            if metadata.get('name', ''):
-                path = metadata.get('name')+'/'
-            else:
-                path = '%08X' % uuid
-      
-        node_entries_magic = self._get_int()
-        
-        if node_entries_magic == 0x00025555:
-            n_total = self._get_int()
-            n_child = self._get_int()
-            n_data = self._get_int()
-            add_offset = self._get_pointer()
-            n_empty = n_total - n_child - n_data;
-        elif node_entries_magic == 0x00045555:
-            n_child = self._get_int()
-            n_data = self._get_int()
-            n_empty = 0
+
+        if uuid is not None:
+            path += (metadata.get('name') or '%08X' % uuid) + '/'
+        return {'path': path, 'uuid': uuid, 'offset': offset}, self._get_node_entries(node_entries)
+
+    def ldk_walk(self):
+        '''
+        Generator walking the node tree of the .ldk archive, yielding
+        ('node', node) and ('entry', data entry) as found: a node, the
+        nodes below it, then its own data entries (the order of
+        ldk_index()). The walk uses a work stack, not recursion, and visits
+        a node offset once: a node reached again (a cycle) is skipped. In
+        partial mode a damaged node or entry is reported and skipped.
+        '''
+        # - int       application specific magic number
+        # - int       archive version
+        # - pointer   {Node} position of the root node (always with list entries)
+        # - double    reserved
+        # - double    reserved
+        # - double    reserved
+        # - double    reserved
+        self.inputfile.seek(0)
+        if self.inputfile.size < 0x30:
+            raise FormatError(0, 'header', '%d bytes' % self.inputfile.size)
+        application_specific_magic_number = self._get_int()
+        archive_version = self._get_int()
+        position_of_the_root_node = self._get_pointer()
+        res1, res2, res3, res4 = self._get_double(), self._get_double(), self._get_double(), self._get_double()
+
+        # (node offset, parent path, uuid) to visit, or (None, path, data entries) to read
+        stack = [(position_of_the_root_node, '/', None)]
+        seen = set()
+        while stack:
+            offset, path, item = stack.pop()
+            if offset is None:
+                if self.stats is not None:
+                    self.stats.ldk_entries += len(item)
+                for offset, uuid in item:
+                    try:
+                        blocks, total_size = self._get_data_blocks(offset)
+                    except DECODE_ERRORS as e:
+                        self._damaged('entry', e, path + '%08X' % uuid)
+                        continue
+                    # the data starts with a byte giving the type of entry
+                    file_type = self.inputfile.buffer[blocks[0][0]] if blocks[0][1] else None
+                    yield 'entry', {'path': path + '%08X' % uuid, 'uuid': uuid,
+                                    'offset': offset, 'type': LDK_TYPES.get(file_type, file_type),
+                                    'size': total_size, 'blocks': blocks}
+                continue
+            if offset in seen:
+                self._damaged('node', FormatError(offset, 'node', 'seen before, skipped'), recovered=True)
+                continue
+            seen.add(offset)
+            try:
+                node, entries = self._get_node(offset, path, item)
+            except DECODE_ERRORS as e:
+                self._damaged('node', e)
+                continue
+            yield 'node', node
+            if entries is None:
+                continue
+            child_entries, data_entries = entries
+            stack.append((None, node['path'], data_entries))
+            for offset, uuid in reversed(child_entries):
+                stack.append((offset, node['path'], uuid))
+
+    def ldk_entries(self, cache=None):
+        '''
+        Generator of the data entries of the .ldk archive: from a valid
+        sidecar index unless cache is False, else streamed from
+        ldk_walk() as they are found.
+        '''
+        index = LdkIndex(self.inputpath)
+        if cache is not False and index.load():
+            for entry in index.entries:
+                yield entry
+            return
+        for kind, item in self.ldk_walk():
+            if kind == 'entry':
+                yield item
+
+    @timed('ldk_index')
+    def ldk_index(self, cache=None):
+        '''
+        Offset index of the .ldk archive (nodes and data entries). A valid
+        sidecar index is reused unless cache is False; with cache=True it
+        is also written after walking the archive.
+        '''
+        index = LdkIndex(self.inputpath)
+        if cache is not False and index.load():
+            return index
+        for kind, item in self.ldk_walk():
+            (index.nodes if kind == 'node' else index.entries).append(item)
+        if cache and index.path is not None:
+            index.save()
+        return index
+
+    def _entry(self, entry):
+        # converter of the file of a data entry (after its type byte), sharing
+        # this one's output, options and stats
+        data = self._get_data(entry['blocks'])
+        converter = alp2gpx(memoryview(data)[1:], self.outputfile, convert=False,
+                            stats=self.stats, options=self.options)
+        converter.diagnostics = self.diagnostics
+        converter.entry = entry['path']
+        return converter
+
+    def _read_entry(self, entry):
+        # (converter, Track) of a data entry, the Track None when not supported
+        converter = self._entry(entry)
+        if entry['type'] == 'trk':
+            return converter, converter.read_track()
+        if entry['type'] in LDK_TYPES.values():
+            return converter, converter.read_landmarks(entry['type'])
+        return converter, None
+
+    def read_entry(self, entry):
+        '''
+        Decoded data entry of the index as a Track of its kind (see Track),
+        the segments of a trk decoded while iterated; None for entry types
+        and versions not supported.
+        '''
+        return self._read_entry(entry)[1]
+
+    def ldk_contents(self):
+        '''
+        Generator of (entry, Track) of every data entry of the .ldk, all
+        types in one walk of the archive (see ldk_entries and read_entry).
+        Entries not supported, or in partial mode damaged, are reported and
+        skipped.
+        '''
+        for entry in self.ldk_entries():
+            try:
+                track = self.read_entry(entry)
+            except DECODE_ERRORS as e:
+                self._damaged('entry', e, entry['path'])
+                continue
+            if track is None:
+                self._unsupported(entry)
+                continue
+            yield entry, track
+
+    def _entry_output(self, entry, track):
+        # split mode: output of an entry under the output directory, in the
+        # folders of the archive, named after the entry and its uuid
+        folders = [_filename(folder) or '_' for folder in entry['path'].split('/')[1:-1]]
+        name = _filename(track.metadata.get('name') or '')
+        filename = '%s-%08X' % (name, entry['uuid']) if name else '%08X' % entry['uuid']
+        extension = WRITERS[self.options.get('format', 'gpx')].extension
+        return os.path.join(self.outputfile, *(folders + [filename + extension]))
+
+    def _write_entry(self, entry, split=False):
+        # write one data entry alone, to the output or in split mode under it;
+        # False for entries not supported
+        try:
+            converter, track = self._read_entry(entry)
+        except DECODE_ERRORS as e:
+            # reported in partial mode, the entry being then done
+            self._damaged('entry', e, entry['path'])
+            return True
+        if track is None:
+            return False
+        if split:
+            converter.outputfile = self._entry_output(entry, track)
+            os.makedirs(os.path.dirname(converter.outputfile), exist_ok=True)
+        if track.kind == 'trk':
+            converter.write_xml(track)
         else:
-            return None
-        
-        child_entries = []
-        for child in range(n_child):
-            offset = self._get_pointer()
-            uuid = self._get_int()
-            child_entries.append({'uuid': uuid, 'offset':offset})
-            
-            
-        self.inputfile.seek(self.inputfile.tell() + n_empty * (8+4))
-        data_entries = []
-        for x in range(n_data):
-            offset = self._get_pointer()
-            uuid = self._get_int()
-            data_entries.append({'offset': offset, 'uuid': uuid, 'path': path})
-            
-        node = []
-        for entry in child_entries:
-            child = self._get_node(entry['offset'], path, entry['uuid']);
-            node.append(child)
-
-        for entry in data_entries:
-            data = self._get_node_data(entry)
-            file_type = unpack('i', data[:4])[0]
-            file_data = data[1:]
-            
-            '''
-            FOR FUTURE REFERENCE
-            type_map = ({'101': 'wpt', '102': 'set', '103':  'rte', '104': 'trk', '105':  'are' });
-            type_str = type_map[file_type]
-            '''
-            
-            if file_type == 104:
-                bytes = io.BytesIO(file_data)
-                self.inputfile = bytes
-                self.inputfile.seek(0)
-                self.parse_trk()
-            else:
-                '''
-                NOT SUPPORTED FILE TYPE
-                FOR NOW
-                '''
-                pass
-              
-            
+            name = _entry_name(entry, track)
+            converter._write_document(name, *_document_parts(name, track))
+        self.points += converter.points
+        self.removed += converter.removed
+        self.statistics = converter.statistics
+        return True
+
+    def extract(self, entry):
+        '''
+        Convert one data entry of the index, reading its blocks directly.
+        Returns False for entry types not supported.
+        '''
+        return self._write_entry(entry)
+
+
     def total_track_time(self):
-        self.inputfile.seek(60)
-        result = self._get_long()
-        return result        
+        return self.inputfile.unpack_at(LONG, 60)[0]
         
     def total_track_elevation_gain(self):
-        self.inputfile.seek(52)
-        result = self._get_double()
-        return result        
+        return self.inputfile.unpack_at(DOUBLE, 52)[0]
         
     def total_track_length_due_to_elevation(self):
-        self.inputfile.seek(44)
-        result = self._get_double()
-        return result
+        return self.inputfile.unpack_at(DOUBLE, 44)[0]
          
     def total_track_length(self):
-        self.inputfile.seek(36)
-        result = self._get_double()
-        return result
+        return self.inputfile.unpack_at(DOUBLE, 36)[0]
     
     ## TODO: datetime.utcfromtimestamp() vs. datetime.fromtimestamp()
     def time_of_first_location(self):
         if self.fileVersion <= 3:
-            self.inputfile.seek(28)
-            result = datetime.fromtimestamp(self._get_timestamp())
+            ts = self.inputfile.unpack_at(LONG, 28)[0]
+            result = datetime.fromtimestamp(ts * 1e-3)
         else:
             result = datetime.fromtimestamp(self.sumary.get('dte') * 1e-3)
         return result
     
     def latitude_of_first_location(self):
-        self.inputfile.seek(24)
-        result = self._get_coordinate()
-        return result
+        return self.inputfile.unpack_at(INT, 24)[0] * 1e-7
     
     def longitude_of_first_location(self):
-        self.inputfile.seek(20)
-        result = self._get_coordinate()
-        return result
+        return self.inputfile.unpack_at(INT, 20)[0] * 1e-7
     
     def number_of_waypoints(self):
-        self.inputfile.seek(16)
-        result = self._get_int()     
-        return(result)
+        return self.inputfile.unpack_at(INT, 16)[0]
     
     def number_of_segments(self):
-        self.inputfile.seek(12)
-        result = self._get_int()     
-        return(result)
+        return self.inputfile.unpack_at(INT, 12)[0]
      
     def number_of_locations(self):
-        self.inputfile.seek(8)
-        result = self._get_int()     
-        return(result)
+        return self.inputfile.unpack_at(INT, 8)[0]
     
         
     def check_version(self):
@@ -396,8 +2253,12 @@ class alp2gpx(object):
         header_size  = self._get_int()          
         return (file_version, header_size);
     
-    def write_xml(self):
+    def write_xml(self, track=None):
         '''
+        Write track (self.track by default) in the output format, GPX
+        unless options['format'] says otherwise, streaming its segments
+        as they are decoded.
+
         <?xml version="1.0" encoding="UTF-8"?>
         <gpx version="1.0">
             <metadata>
@@ -420,13 +2281,23 @@ class alp2gpx(object):
             </trkseg></trk>
         </gpx>
         '''
-        tsdebut = self.time_of_first_location()
-        if not self.metadata.get('name'):
+        if track is None:
+            track = self.track
+        try:
+            tsdebut = self.time_of_first_location()
+        except DECODE_ERRORS + (TypeError, OSError) as e:
+            self._damaged('time of first location', FormatError(28 if self.fileVersion <= 3 else 8,
+                                                                'time of first location', str(e)))
+            tsdebut = None
+        if tsdebut is None:
+            # damaged header: the name alone
+            name = track.metadata.get('name') or 'Track'
+        elif not track.metadata.get('name'):
             name = tsdebut.strftime("%Y-%m-%d %H:%M:%S")
             filename = tsdebut.strftime("%y-%m-%d")
         else:
-            name = tsdebut.strftime("%Y-%m-%d %H:%M:%S") + ' ' + self.metadata.get('name')
-            filename = tsdebut.strftime("%y-%m-%d") + ' ' + self.metadata.get('name')
+            name = tsdebut.strftime("%Y-%m-%d %H:%M:%S") + ' ' + track.metadata.get('name')
+            filename = tsdebut.strftime("%y-%m-%d") + ' ' + track.metadata.get('name')
 
             # suppress characters not permitted in filename
             for i in [';', ':', '!', "*", '/', '\\', '.', ','] :
@@ -437,52 +2308,146 @@ class alp2gpx(object):
             
         # print('Name:', name)
         
-        root = ET.Element('gpx', xmlns="http://www.topografix.com/GPX/1/1", version = '1.1', creator="Alp2gpx" )
-        root.text = '\n'
-        tree = ET.ElementTree(root)
-        metadata = ET.SubElement(root, 'metadata')
-        metadata.text = '\n'
-        metadata.tail = '\n'
-        desc = ET.SubElement(metadata, 'desc')
-        desc.text = name
-        desc.tail = '\n'
-        link = ET.SubElement(metadata, 'link', href='https://github.com/jachetto/alp2gpx')
-        link.tail = '\n'
+        if track.parts is not None and not self.options.get('simplify'):
+            # the simplification needs whole segments, the rest is streamed
+            self._write_document(name, track.waypoints, parts=[(name, track.parts)])
+        else:
+            self._write_document(name, track.waypoints, tracks=[(name, track.segments)])
+
+    @timed('write')
+    def _write_document(self, name, waypoints=(), routes=(), tracks=(), parts=()):
+        # one output document in the format of the options: waypoints, routes
+        # ((name, points)) and tracks ((name, segments)), their segments
+        # simplified and measured as asked while they are written, or tracks
+        # as parts ((name, (new, Segment) parts), see Track), not simplified
+        options = dict(self.options)
+        simplify = options.pop('simplify', None)
+        statistics = options.pop('statistics', None)
+        for key in ('jobs', 'split', 'partial'):
+            options.pop(key, None)
+        writer = WRITERS[options.pop('format', 'gpx')](self.outputfile, **options)
+        if simplify:
+            simplifier = Simplifier(stats=self.stats, **simplify)
+        if statistics:
+            track_statistics = TrackStatistics(stats=self.stats)
+        try:
+            writer.begin(name, waypoints)
+            for route_name, points in routes:
+                writer.route(route_name, points)
+            for track_name, segments in tracks:
+                if simplify:
+                    segments = simplifier.segments(segments)
+                if statistics:
+                    segments = track_statistics.segments(segments)
+                for s in segments:
+                    writer.segment(track_name, s)
+            for track_name, track_parts in parts:
+                started = False
+                for new, part in track_parts:
+                    if new:
+                        if started:
+                            writer.end_segment()
+                        writer.begin_segment(track_name)
+                        started = True
+                    if statistics:
+                        track_statistics.add(part, new)
+                    writer.write_points(part)
+                if started:
+                    writer.end_segment()
+            if statistics:
+                self.statistics = writer.statistics = track_statistics.as_dict()
+            writer.end()
+        except BaseException:
+            writer.abort()
+            raise
+        self.points += writer.points
+        if simplify:
+            self.removed += simplifier.removed
+        if self.stats is not None:
+            self.stats.output_bytes += writer.bytes
+        
         
-        for wp in self.waypoints:
-            wpt = ET.SubElement(root, 'wpt', lat = '%s' % wp['location']['lat'], lon = '%s' % wp['location']['lon'] )
-            node = ET.SubElement(wpt, 'ele')
-            node.text = '%s' % wp['location']['alt']
-            node = ET.SubElement(wpt, 'name')
-            node.text = wp['meta']['name']
+    @timed('header')
+    def read_header(self):
+        '''
+        Read the .trk header and {Metadata} (and for version 4 the summary
+        block), leaving the input at the {Waypoints}. Nothing can be decoded
+        without them: a damaged header raises FormatError, in partial mode
+        too.
+        '''
+        try:
+            (self.fileVersion, self.headerSize)= self.check_version()    
+#             print("Version:", self.fileVersion)
+            if self.fileVersion not in MIN_LOCATION:
+                raise FormatError(0, 'version', 'unknown file version %d' % self.fileVersion)
             
-        for s in self.segments:
-            trk = ET.SubElement(root, 'trk')
-            trk.text = '\n'
-            trk.tail = '\n'
-            tname = ET.SubElement(trk, 'name')
-            tname.text = name
-            tname.tail = '\n'
-
-            trkseg = ET.SubElement(trk, 'trkseg')
-            trkseg.text = '\n'
-            trkseg.tail = '\n'
-            for p in s:
-                trkpt = ET.SubElement(trkseg, 'trkpt', lat = '%s' % p['lat'], lon = '%s' % p['lon'] )
-                trkpt.text = '\n'
-                trkpt.tail = '\n'
-                node = ET.SubElement(trkpt, 'ele')
-                node.text = '%s' % p['alt']                
-                node.tail = '\n'
-                d = datetime.utcfromtimestamp(int(p['ts']))
-                tz = d.strftime("%Y-%m-%dT%H:%M:%SZ")
-                node = ET.SubElement(trkpt, 'time')
-                node.text = tz
-                node.tail = '\n'
+            if self.fileVersion <= 3:
+                self.inputfile.seek(self._size('header', self.headerSize) + 8)
+                self.metadata = self._get_metadata(self.fileVersion)
+            else:            
+                # read sumary data
+                self.inputfile.seek(8)
+                self.sumary = self._get_metadata(self.fileVersion)
+                # print("time of first loc 2:", self.sumary.get('dte'))
+
+                # skip 2 unknown int
+                x1 = self._get_int() 
+                x2 = self._get_int()  
+
+                # read metatdata
+                self.metadata = self._get_metadata(self.fileVersion)
+#                 print(self.metadata.get('name'))
                 
-        tree.write(self.outputfile, encoding='utf-8', xml_declaration=True)
-        
-        
+                # skip 2 unknown int
+                x1 = self._get_int()  
+                x2 = self._get_int()  
+        except DECODE_ERRORS as e:
+            if not isinstance(e, FormatError):
+                e = FormatError(self.inputfile.tell(), 'header', '%s: %s' % (type(e).__name__, e))
+            raise e
+
+    def info(self, statistics=False):
+        '''
+        Summary of the input read from its headers only, no location is
+        decoded: the header fields of a .trk (the summary block for
+        version 4), or the entry list of an .ldk. With statistics, the
+        tracks are decoded for their TrackStatistics, checked against the
+        header fields of version 2 and 3 tracks (validation).
+        '''
+        result = {'file': self.inputpath}
+        if self.input_type() == 'ldk':
+            result['type'] = 'ldk'
+            result['entries'] = []
+            for entry in self.ldk_index().entries:
+                result['entries'].append(dict((k, entry[k]) for k in ('path', 'uuid', 'type', 'size')))
+                if statistics and entry['type'] == 'trk':
+                    result['entries'][-1].update(self._entry(entry).info(statistics))
+                    del result['entries'][-1]['file']
+            return result
+
+        self.read_header()
+        result['type'] = 'trk'
+        result['version'] = self.fileVersion
+        result['name'] = self.metadata.get('name')
+        if self.fileVersion <= 3:
+            for field in HEADER_FIELDS:
+                result[field] = getattr(self, field)()
+            ts = self.inputfile.unpack_at(LONG, 28)[0] * 1e-3
+        else:
+            result['summary'] = dict((k, _jsonable(v)) for k, v in self.sumary.items())
+            dte = self.sumary.get('dte', 0)
+            ts = dte * 1e-3 if isinstance(dte, (int, float)) else None
+        result['time_of_first_location'] = _isotime(ts)
+        if statistics:
+            track_statistics = TrackStatistics(stats=self.stats)
+            self._get_waypoints()
+            for segment in self._iter_segments(self.fileVersion):
+                track_statistics.add(segment)
+            result['statistics'] = track_statistics.as_dict()
+            if self.fileVersion <= 3:
+                result['validation'] = track_statistics.validate(result)
+        return result
+
     def parse_trk(self):
         # version 3 (version 2 is the same but uses a different {Metadata} and {Segments} struct
         # - int         file version
@@ -528,72 +2493,1433 @@ class alp2gpx(object):
         total_track_time = self.total_track_time()
         '''
         
-        (self.fileVersion, self.headerSize)= self.check_version()    
-#         print("Version:", self.fileVersion)
-        
-        if self.fileVersion <= 3:
-            self.inputfile.seek(self.headerSize+8)
-            self.metadata = self._get_metadata(self.fileVersion)
-            self.waypoints = self._get_waypoints()
-            self.segments = self._get_segments(self.fileVersion)
-            self.write_xml()
-        else:            
-            # read sumary data
-            self.inputfile.seek(8)
-            self.sumary = self._get_metadata(self.fileVersion)
-            # print("time of first loc 2:", self.sumary.get('dte'))
-
-            # skip 2 unknown int
-            x1 = self._get_int() 
-            x2 = self._get_int()  
-
-            # read metatdata
-            self.metadata = self._get_metadata(self.fileVersion)
-#             print(self.metadata.get('name'))
-            
-            # skip 2 unknown int
-            x1 = self._get_int()  
-            x2 = self._get_int()  
+        # read and write track, one segment at a time
+        self.track = self.read_track()
+        self.write_xml()
+
+    def read_track(self):
+        '''
+        Track of the .trk: header, metadata and waypoints are read, the
+        segments are a generator decoding them as they are iterated, over
+        options['jobs'] processes when more than 1 (see segment_pieces()),
+        in this process in partial mode.
+        '''
+        self.read_header()
+        self.waypoints = self._get_waypoints()
+        jobs = self.options.get('jobs')
+        if jobs and jobs > 1 and self.inputpath is not None and not self.options.get('partial'):
+            return Track(self.fileVersion, self.metadata, self.waypoints,
+                         self._iter_parallel_segments(self.fileVersion, jobs))
+        return Track(self.fileVersion, self.metadata, self.waypoints, self._iter_segments(self.fileVersion),
+                     parts=self._iter_segment_parts(self.fileVersion))
 
-            # read waypoints (not tested with waypoints in file)
-            self.waypoints = self._get_waypoints()
+    @timed('landmarks')
+    def read_landmarks(self, kind):
+        '''
+        Waypoint (wpt), set of waypoints (set), route (rte) or area (are) of
+        an .ldk data entry as a Track of that kind, None for versions other
+        than 2 and 3.
+        '''
+        # - int         file version
+        # - int         header size (size of data to before {Metadata})
+        # - header      wpt: coordinate longitude, coordinate latitude
+        #               set, rte: int number of waypoints, coordinates of the first one
+        #               (rte: + double total length, double length due to elevation
+        #               changes, double elevation gain)
+        #               are: coordinates of the first location, double perimeter, double area
+        # - {Metadata}  (version 2 or 3)
+        # - wpt: {Location}, set and rte: {Waypoints},
+        #   are: int number of locations, {Location}...
+        (self.fileVersion, self.headerSize) = self.check_version()
+        if self.fileVersion not in (2, 3):
+            return None
+        self.inputfile.seek(self._size('header', self.headerSize) + 8)
+        self.metadata = self._get_metadata(self.fileVersion)
+        waypoints, segments = [], []
+        if kind == 'wpt':
+            waypoints.append({'meta': self.metadata, 'location': self._get_location(self.fileVersion)})
+            if self.stats is not None:
+                self.stats.waypoints += 1
+        elif kind in ('set', 'rte'):
+            waypoints = self._get_waypoints()
+        else:
+            nlocations = self._count('locations', self._get_int(), MIN_LOCATION[self.fileVersion])
+            segments.append(self._get_locations(self.fileVersion, nlocations))
+            if self.stats is not None:
+                self.stats.segments += 1
+                self.stats.points += len(segments[0])
+        return Track(self.fileVersion, self.metadata, waypoints, segments, kind)
 
-            # read track
-            self.segments = self._get_segments(self.fileVersion)
+    def tracks(self):
+        '''
+        Generator of the tracks of the input (see read_track): the .trk, or
+        the trk entries of the .ldk, each decoded by its own reader.
+        '''
+        if self.input_type() != 'ldk':
+            yield self.read_track()
+            return
+        for entry in self.ldk_entries():
+            if entry['type'] == 'trk':
+                yield self._entry(entry).read_track()
 
-            self.write_xml()
-        #self.inputfile.seek(0)
-   
-    
     def parse_ldk(self):
-        # - int       application specific magic number
-        # - int       archive version
-        # - pointer   {Node} position of the root node (always with list entries)
-        # - double    reserved
-        # - double    reserved
-        # - double    reserved
-        # - double    reserved            
-        self.inputfile.seek(0)
-        application_specific_magic_number = self._get_int()
-        archive_version = self._get_int()
-        position_of_the_root_node = self._get_pointer()
-        res1, res2, res3, res4 = self._get_double(), self._get_double(), self._get_double(), self._get_double()
-        
-        root_node = self._get_node(position_of_the_root_node)
-        
-        pass
-        
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+        '''
+        Convert every data entry of the .ldk in one walk of the archive: to
+        one document (the waypoints of all the entries, the routes, then the
+        tracks and areas, named after their folder path), or with
+        options['split'] each entry to its own file, the output being a
+        directory where the folders of the archive are created.
+        '''
+        if self.options.get('split'):
+            for entry in self.ldk_entries():
+                if not self._write_entry(entry, split=True):
+                    self._unsupported(entry)
+            return
+        waypoints, routes, tracks = [], [], []
+        for entry, track in self.ldk_contents():
+            # the folder path of the entry (its path without the uuid) and its name
+            parts = _document_parts(entry['path'][:-8] + _entry_name(entry, track), track)
+            waypoints.extend(parts[0])
+            routes.extend(parts[1])
+            tracks.extend(parts[2])
+        name = os.path.splitext(os.path.basename(self.inputpath))[0] if self.inputpath else 'AlpineQuest archive'
+        self._write_document(name, waypoints, routes, tracks)
+
+
+def _entry_name(entry, track):
+    # name of an .ldk entry in the outputs: its own, else its uuid
+    return track.metadata.get('name') or '%08X' % entry['uuid']
+
+
+def _document_parts(name, track):
+    # (waypoints, routes, tracks) of track in an output document
+    if track.kind == 'rte':
+        return [], [(name, track.waypoints)], []
+    return track.waypoints, [], [(name, track.segments)] if track.kind in ('trk', 'are') else []
+
+
+def _filename(text):
+    # text without the characters not permitted in file names
+    for c in (';', ':', '!', '*', '/', '\\', '.', ','):
+        text = text.replace(c, '-')
+    return text.strip()
+
+
+# decoder and spool of the pool processes of alp2gpx._iter_parallel_segments
+_decoder = None
+_spool = None
+
+
+def _open_decoder(path, version, spool_path):
+    global _decoder, _spool
+    _decoder = alp2gpx(path, None, convert=False)
+    _decoder.fileVersion = version
+    with open(spool_path, 'r+b') as f:
+        _spool = mmap.mmap(f.fileno(), 0)
+
+
+def _decode_piece(offset, count, start):
+    # decode count locations at offset, their columns written to the spool at start
+    _decoder.inputfile.seek(offset)
+    segment = _decoder._get_locations(_decoder.fileVersion, count)
+    for name in LOCATION_COLUMNS:
+        _spool[start:start + 8 * count] = memoryview(getattr(segment, name)).cast('B')
+        start += 8 * count
+
+
+def tracks(source, stats=None):
+    '''
+    Decoded tracks of source (a path, bytes, memoryview or binary file
+    object), one per .trk or per trk entry of an .ldk, as Track objects
+    whose segments are decoded while iterated. Nothing is written.
+    '''
+    return alp2gpx(source, None, convert=False, stats=stats).tracks()
+
+
+def convert(source, output=None, format='gpx', stats=None, **options):
+    '''
+    Convert source (a path, bytes, memoryview or binary file object) to
+    format. The result is streamed to output (a path or a writable binary
+    file object) and the number of points is returned or, without output,
+    returned as bytes. options: writer options (precision, ele_precision,
+    milliseconds), simplify and statistics (see alp2gpx).
+    '''
+    options['format'] = format
+    target = io.BytesIO() if output is None else output
+    q = alp2gpx(source, target, convert=False, stats=stats, options=options)
+    q.convert()
+    return target.getvalue() if output is None else q.points
+
+
+class TrackMerger(object):
+    '''
+    Time-ordered k-way merge of the points of tracks, each track being in
+    time order as recorded: a heap holds the next point of every track, so
+    memory is the segment being decoded for each input, not the total
+    number of points. A point is dropped as a duplicate when a point of
+    another track already kept lies within time_epsilon seconds and
+    distance_epsilon metres of it (time_epsilon None: no deduplication). chunks() gives the
+    merged points in Segments of at most chunk_points points; a new track
+    segment starts after a gap of more than gap seconds (None: one segment).
+    '''
+    chunk_points = 65536
+    # order of the values of a merged point
+    ORDER = ('ts', 'lon', 'lat', 'alt', 'acc', 'bar')
 
-    parser.add_argument("input", help = "input file to convert (.trk, etc.)")
+    def __init__(self, tracks, time_epsilon=1.0, distance_epsilon=5.0, gap=None, stats=None):
+        self.tracks = list(tracks)
+        self.time_epsilon = time_epsilon
+        self.distance_epsilon = distance_epsilon
+        self.gap = gap
+        self.stats = stats
+        self.points = 0         # points kept
+        self.duplicates = 0
+
+    def _points(self, track, source):
+        # points as tuples of ORDER values and the track number
+        for segment in track.segments:
+            yield from zip(*[getattr(segment, name) for name in self.ORDER] + [repeat(source)])
+
+    def _chunk(self, points):
+        self.points += len(points)
+        return Segment(**dict((name, array('d', column)) for name, column in zip(self.ORDER, zip(*points))))
+
+    def chunks(self):
+        '''
+        Generator of (starts a new segment, Segment) of the merged points.
+        '''
+        # tuples compare on their timestamp first
+        merged = heapq.merge(*[self._points(track, source) for source, track in enumerate(self.tracks)])
+        epsilon = self.time_epsilon
+        distance2 = (self.distance_epsilon / METRES_PER_DEGREE) ** 2
+        recent = deque()        # points kept in the last epsilon seconds
+        chunk = []
+        new, last = True, None
+        reference, kx2 = None, 1.0
+        for point in merged:
+            ts = point[0]
+            if epsilon is not None:
+                while recent and recent[0][0] < ts - epsilon:
+                    recent.popleft()
+                if recent:
+                    lon, lat, source = point[1], point[2], point[-1]
+                    if reference is None or abs(lat - reference) > 0.5:
+                        reference = lat
+                        kx2 = math.cos(math.radians(lat)) ** 2
+                    for p in recent:
+                        if p[-1] != source and (lon - p[1]) ** 2 * kx2 + (lat - p[2]) ** 2 <= distance2:
+                            break
+                    else:
+                        p = None
+                    if p is not None:
+                        self.duplicates += 1
+                        continue
+                recent.append(point)
+            if self.gap is not None and last is not None and ts - last > self.gap:
+                if chunk:
+                    yield new, self._chunk(chunk)
+                    chunk = []
+                new = True
+            last = ts
+            chunk.append(point)
+            if len(chunk) >= self.chunk_points:
+                yield new, self._chunk(chunk)
+                chunk = []
+                new = False
+        if chunk:
+            yield new, self._chunk(chunk)
+        if self.stats is not None:
+            self.stats.duplicates += self.duplicates
+
+
+def merge(sources, output, format='gpx', name=None, time_epsilon=1.0, distance_epsilon=5.0,
+          gap=None, simplify=None, statistics=False, stats=None, partial=False, split=False, **options):
+    '''
+    Merge the tracks of sources (paths, buffers or binary file objects, all
+    the trk entries of .ldk archives) into one time-ordered, deduplicated
+    track written to output (a path or a writable binary file object), see
+    TrackMerger. simplify: keyword arguments of Simplifier, partial: decode
+    damaged sources as far as possible (see alp2gpx), options those of the
+    writer (WRITER_OPTIONS, others are ignored); split does not apply to
+    one merged output and is refused. Returns a dict of counts: tracks,
+    points (written), duplicates and removed (by the Simplifier), the
+    diagnostics of the damaged parts skipped, and with statistics the
+    TrackStatistics of the merged track (also written in the output).
+    '''
+    if split:
+        raise ValueError('a merge writes one output, it cannot be split')
+    tracks, waypoints, readers = [], [], []
+    for source in sources:
+        readers.append(alp2gpx(source, None, convert=False, stats=stats, options={'partial': partial}))
+        for track in readers[-1].tracks():
+            tracks.append(track)
+            waypoints.extend(track.waypoints)
+    merger = TrackMerger(tracks, time_epsilon, distance_epsilon, gap, stats)
+    simplifier = Simplifier(stats=stats, **simplify) if simplify else None
+    track_statistics = TrackStatistics(stats=stats) if statistics else None
+    writer = WRITERS[format](output, **dict((key, options[key]) for key in WRITER_OPTIONS if key in options))
+    name = name or 'Merged track'
+    try:
+        writer.begin(name, waypoints)
+        started = False
+        for new, chunk in merger.chunks():
+            if new:
+                if started:
+                    writer.end_segment()
+                writer.begin_segment(name)
+                started = True
+            if simplifier:
+                chunk = simplifier.segment(chunk)
+            if track_statistics:
+                track_statistics.add(chunk, new)
+            writer.write_points(chunk)
+        if started:
+            writer.end_segment()
+        result = {'tracks': len(tracks), 'points': writer.points, 'duplicates': merger.duplicates,
+                  'removed': simplifier.removed if simplifier else 0,
+                  'diagnostics': [dict(diagnostic, file=reader.inputpath)
+                                  for reader in readers for diagnostic in reader.diagnostics]}
+        if track_statistics:
+            result['statistics'] = writer.statistics = track_statistics.as_dict()
+        writer.end()
+    except BaseException:
+        writer.abort()
+        raise
+    if stats is not None:
+        stats.output_bytes += writer.bytes
+    return result
+
+
+INPUT_EXTENSIONS = ('.trk', '.ldk')
+
+
+def find_inputs(sources):
+    '''
+    Expand files, directories (searched recursively), glob patterns and
+    @list files (one source per line) into (input path, base directory)
+    pairs; the base directory is what the output tree mirrors.
+    '''
+    for source in sources:
+        if source.startswith('@'):
+            with open(source[1:]) as f:
+                lines = [line.strip() for line in f]
+            for found in find_inputs([line for line in lines if line and not line.startswith('#')]):
+                yield found
+        elif os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if os.path.splitext(name)[1].lower() in INPUT_EXTENSIONS:
+                        yield os.path.join(root, name), source
+        elif glob.has_magic(source):
+            # mirror from the last directory before the first wildcard
+            base = source
+            while glob.has_magic(base):
+                base = os.path.dirname(base)
+            for path in sorted(glob.glob(source, recursive=True)):
+                if os.path.isfile(path):
+                    yield path, base
+        else:
+            yield source, os.path.dirname(source)
+
+
+def output_path(inputfile, base=None, outputdir=None, ext='.gpx'):
+    # output next to the input, or at the same relative place under outputdir
+    if outputdir is None:
+        return os.path.splitext(inputfile)[0] + ext
+    relative = os.path.relpath(inputfile, base or os.path.dirname(inputfile))
+    return os.path.join(outputdir, os.path.splitext(relative)[0] + ext)
+
+
+def fingerprint(path, hashed=True):
+    # size, mtime and (optionally) SHA-256 of the file content
+    st = os.stat(path)
+    result = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if hashed:
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        result['sha256'] = h.hexdigest()
+    return result
+
+
+class Manifest(object):
+    '''
+    JSON record of converted inputs: fingerprint, output path, converter
+    version and output options. An input is current (and can be skipped)
+    when all of them match and the output still exists. Size and mtime are
+    checked first, the content hash only when they changed.
+    '''
+    filename = '.alp2gpx-manifest.json'
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            # a damaged manifest is started again: everything is converted
+            try:
+                with open(path) as f:
+                    entries = json.load(f).get('entries', {})
+            except (ValueError, KeyError, TypeError, AttributeError):
+                entries = {}
+            if isinstance(entries, dict):
+                self.entries = entries
+
+    def is_current(self, inputfile, outputfile, options):
+        entry = self.entries.get(os.path.abspath(inputfile))
+        try:
+            if (entry is None or entry['converter'] != __version__ or entry['options'] != options
+                    or entry['output'] != os.path.abspath(outputfile) or not os.path.exists(outputfile)):
+                return False
+            stat = fingerprint(inputfile, hashed=False)
+            if stat['size'] != entry['size']:
+                return False
+            if stat['mtime_ns'] != entry['mtime_ns']:
+                # touched: same content means nothing to convert
+                if fingerprint(inputfile)['sha256'] != entry['sha256']:
+                    return False
+                entry['mtime_ns'] = stat['mtime_ns']
+        except (KeyError, TypeError):
+            # an entry damaged by hand: converted again, and recorded anew
+            return False
+        return True
+
+    def record(self, inputfile, outputfile, options, filestamp):
+        entry = dict(filestamp)
+        entry.update({'output': os.path.abspath(outputfile), 'converter': __version__,
+                      'options': options})
+        self.entries[os.path.abspath(inputfile)] = entry
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'converter': __version__, 'entries': self.entries}, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def convert_file(job):
+    '''
+    Convert one (inputfile, outputfile[, options]) job, options being
+    keyword arguments of alp2gpx; never raises, so a damaged file does not
+    stop a batch. Returns a result dict, including the input fingerprint
+    (taken before converting) for the manifest, the stats if asked and
+    the diagnostics of the damaged data (see alp2gpx._damaged).
+    '''
+    inputfile, outputfile = job[:2]
+    options = job[2] if len(job) > 2 else {}
+    result = {'input': inputfile, 'output': outputfile, 'ok': False,
+              'error': None, 'points': 0, 'removed': 0, 'seconds': 0.0, 'fingerprint': None,
+              'stats': None, 'diagnostics': []}
+    start = time.perf_counter()
+    try:
+        result['fingerprint'] = fingerprint(inputfile)
+        directory = os.path.dirname(outputfile)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        q = alp2gpx(inputfile, outputfile, **options)
+        result['points'] = q.points
+        result['removed'] = q.removed
+        result['diagnostics'] = q.diagnostics
+        if q.stats is not None:
+            result['stats'] = q.stats.as_dict()
+        result['ok'] = True
+    except (Exception, SystemExit) as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+        if isinstance(e, FormatError):
+            result['diagnostics'] = [e.as_dict()]
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def convert_batch(jobs, workers=None, report=None):
+    '''
+    Convert (inputfile, outputfile[, options]) jobs over a process pool of workers
+    processes (default: one per CPU, 1 = in this process). report, when
+    given, is called with each result as it completes. Returns the results.
+    '''
+    jobs = list(jobs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(jobs)))
+    results = []
+    if workers == 1:
+        completed = map(convert_file, jobs)
+    else:
+        pool = multiprocessing.Pool(workers)
+        completed = pool.imap_unordered(convert_file, jobs)
+    try:
+        for result in completed:
+            results.append(result)
+            if report:
+                report(result)
+    finally:
+        if workers > 1:
+            pool.close()
+            pool.join()
+    return results
+
+
+def print_result(result):
+    if result['ok']:
+        print('%8.3fs %10d pts  %s -> %s' % (result['seconds'], result['points'],
+                                            result['input'], result['output']))
+    else:
+        print('  FAILED %s: %s' % (result['input'], result['error']), file=sys.stderr)
+    print_diagnostics(result['input'], result.get('diagnostics'))
+
+
+def print_diagnostics(path, diagnostics):
+    # damaged data of path, one JSON object per line
+    for diagnostic in diagnostics or ():
+        print(json.dumps(dict(diagnostic, file=path)), file=sys.stderr)
+
+
+def print_summary(results, seconds):
+    points = sum(r['points'] for r in results)
+    failed = sum(1 for r in results if not r['ok'])
+    print('%d files, %d failed, %d points in %.2fs (%.0f points/s)' % (
+        len(results), failed, points, seconds, points / seconds if seconds else 0))
+    removed = sum(r.get('removed', 0) for r in results)
+    if removed:
+        print('%d points removed by simplification (%.1f%%)' % (removed, 100.0 * removed / (removed + points)))
+
+
+def profile(function, path):
+    '''
+    Run function under cProfile and tracemalloc: the profile is dumped to
+    path (for pstats/snakeviz), a summary is printed to stderr.
+    '''
+    import cProfile
+    import pstats
+    import tracemalloc
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    try:
+        return profiler.runcall(function)
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        profiler.dump_stats(path)
+        pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(20)
+        print('traced memory: peak %.1f MB, current %.1f MB' % (peak / 1e6, current / 1e6), file=sys.stderr)
+        for stat in snapshot.statistics('lineno')[:10]:
+            print(stat, file=sys.stderr)
+        print('profile written to %s' % path, file=sys.stderr)
+
+
+def add_simplify_arguments(parser):
+    parser.add_argument("--simplify", type = float, metavar = 'METRES', default = None,
+                        help = "Douglas-Peucker simplification of the tracks with this tolerance")
+    parser.add_argument("--min-distance", type = float, metavar = 'METRES', default = None,
+                        help = "drop points closer than this to the last kept point")
+    parser.add_argument("--min-time", type = float, metavar = 'SECONDS', default = None,
+                        help = "drop points sooner than this after the last kept point")
+    parser.add_argument("--stationary", type = float, metavar = 'METRES', default = None,
+                        help = "reduce stops (points within this radius for --stationary-time) to 2 points")
+    parser.add_argument("--stationary-time", type = float, metavar = 'SECONDS', default = 60.0,
+                        help = "shortest stop removed by --stationary (default: 60)")
+
+
+def simplify_options(args):
+    # Simplifier keyword arguments of the command line, None if no reduction is asked
+    options = {}
+    for name, key in (('simplify', 'tolerance'), ('min_distance', 'min_distance'),
+                      ('min_time', 'min_time'), ('stationary', 'stationary')):
+        if getattr(args, name) is not None:
+            options[key] = getattr(args, name)
+    if args.stationary is not None:
+        options['stationary_time'] = args.stationary_time
+    return options or None
+
+
+def split_extension(args, path):
+    # extension of the output of path: none for the directory of a split .ldk
+    if args.split and path.lower().endswith('.ldk'):
+        return ''
+    return WRITERS[args.format].extension
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if argv and argv[0] in COMMANDS:
+        return COMMANDS[argv[0]](argv[1:])
+    parser = argparse.ArgumentParser(epilog = "other commands: %s (see alp2gpx.py COMMAND -h)"
+                                              % ', '.join(sorted(COMMANDS)))
+
+    parser.add_argument("input", nargs = '+',
+                        help = "input files to convert (.trk, .ldk), directories, glob patterns or @listfile")
     parser.add_argument("-o", "--output", 
                         default = None,  # Handled after parser.parse_args()
-                        help = "output base name (default input file path and base name)")
+                        help = "output file (default: input file path and base name, extension of the format)")
+    parser.add_argument("-d", "--output-dir", default = None,
+                        help = "batch mode: write outputs to a tree mirroring the inputs under this directory")
+    parser.add_argument("-j", "--jobs", type = int, default = None,
+                        help = "batch mode: number of worker processes (default: number of CPUs); "
+                               "a single .trk: processes decoding its segments in parallel (default: 1)")
+    parser.add_argument("--list", action = 'store_true',
+                        help = "list the entries of .ldk archives (uuid, type, size, path)")
+    parser.add_argument("--extract", action = 'append', metavar = 'PATH|UUID',
+                        help = "convert only this entry of an .ldk archive (repeatable)")
+    parser.add_argument("--split", action = 'store_true',
+                        help = "write each entry of .ldk archives to its own file, in a directory named after "
+                               "the archive (or -o) with the folders of the archive (default: one document)")
+    parser.add_argument("--info", action = 'store_true',
+                        help = "print a JSON summary of each input (one per line) from its headers, without converting")
+    parser.add_argument("--manifest", nargs = '?', const = '', default = None,
+                        help = "skip inputs unchanged since the last run, recorded in this manifest "
+                               "(default: %s in the output directory, without -d in the directory "
+                               "common to the outputs)" % Manifest.filename)
+    parser.add_argument("-f", "--format", choices = sorted(WRITERS), default = 'gpx',
+                        help = "output format (default: gpx)")
+    parser.add_argument("--merge", action = 'store_true',
+                        help = "merge all the tracks of the inputs into one time-ordered, deduplicated track "
+                               "(output: -o, default merged.EXT in the output directory)")
+    parser.add_argument("--dedupe-time", type = float, metavar = 'SECONDS', default = 1.0,
+                        help = "merge: drop points within this time of a kept point... (default: 1)")
+    parser.add_argument("--dedupe-distance", type = float, metavar = 'METRES', default = 5.0,
+                        help = "...and within this distance of it (default: 5)")
+    parser.add_argument("--merge-gap", type = float, metavar = 'SECONDS', default = None,
+                        help = "merge: start a new segment after a gap longer than this")
+    parser.add_argument("--precision", type = int, default = None,
+                        help = "decimals of latitudes and longitudes (default: full precision)")
+    parser.add_argument("--ele-precision", type = int, default = None,
+                        help = "decimals of elevations (default: full precision)")
+    parser.add_argument("--milliseconds", action = 'store_true',
+                        help = "keep the milliseconds of timestamps (version 4 tracks)")
+    add_simplify_arguments(parser)
+    parser.add_argument("--statistics", action = 'store_true',
+                        help = "length, elevation gain/loss, duration, moving time and speeds of each track, "
+                               "written in gpx and geojson outputs; with --info checked against the header")
+    parser.add_argument("--partial", action = 'store_true',
+                        help = "decode damaged or truncated inputs as far as possible: the damaged parts are "
+                               "skipped, reported on stderr (JSON: offset, field, reason)")
+    parser.add_argument("--stats", action = 'store_true',
+                        help = "print a JSON report of phase timings and counters to stderr")
+    parser.add_argument("--profile", metavar = 'FILE', default = None,
+                        help = "run under cProfile and tracemalloc (in one process), dump the profile to FILE")
 
-    args = parser.parse_args()
-    if args.output is None:
-        args.output = '%s.gpx' % os.path.splitext(args.input)[0]
+    args = parser.parse_args(argv)
+    if args.profile:
+        args.jobs = 1
+        return profile(lambda: run(parser, args), args.profile)
+    return run(parser, args)
 
-    
-    q = alp2gpx(args.input, args.output)
+
+def run(parser, args):
+    if args.info:
+        status = 0
+        for path, base in find_inputs(args.input):
+            try:
+                info = alp2gpx(path, None, convert=False).info(args.statistics)
+            except (Exception, SystemExit) as e:
+                info = {'file': path, 'error': '%s: %s' % (type(e).__name__, e)}
+                status = 1
+            print(json.dumps(info))
+        return status
+
+    # output format and writer options, also recorded in the manifest
+    output_options = {'format': args.format}
+    for name in ('precision', 'ele_precision'):
+        if getattr(args, name) is not None:
+            output_options[name] = getattr(args, name)
+    for name in ('milliseconds', 'statistics', 'split', 'partial'):
+        if getattr(args, name):
+            output_options[name] = True
+    if simplify_options(args):
+        output_options['simplify'] = simplify_options(args)
+    extension = WRITERS[args.format].extension
+    options = {'options': output_options}
+    if args.stats:
+        options['stats'] = True
+
+    if args.list or args.extract:
+        # .ldk random access, through the sidecar index
+        status = 0
+        for path, base in find_inputs(args.input):
+            q = alp2gpx(path, None, convert=False, options=output_options)
+            index = q.ldk_index(cache=True)
+            if args.list:
+                for entry in index.entries:
+                    print('%08X %-4s %10d %s' % (entry['uuid'], entry['type'], entry['size'], entry['path']))
+                continue
+            entries = [e for selector in args.extract for e in index.find(selector)]
+            if not entries:
+                print('%s: no entry %s' % (path, ', '.join(args.extract)), file=sys.stderr)
+                status = 1
+            for entry in entries:
+                if args.output and len(entries) == 1:
+                    q.outputfile = args.output
+                else:
+                    q.outputfile = '%s-%08X%s' % (os.path.splitext(path)[0], entry['uuid'], extension)
+                if not q.extract(entry):
+                    print('%s: %s entries not supported yet' % (entry['path'], entry['type']), file=sys.stderr)
+                    status = 1
+        return status
+
+    if args.merge:
+        if args.output is None:
+            args.output = os.path.join(args.output_dir or '.', 'merged' + extension)
+        stats = Stats() if args.stats else None
+        if args.split:
+            parser.error('--split does not apply to --merge (one merged output)')
+        try:
+            result = merge([path for path, base in find_inputs(args.input)], args.output,
+                           name=os.path.splitext(os.path.basename(args.output))[0],
+                           time_epsilon=args.dedupe_time, distance_epsilon=args.dedupe_distance,
+                           gap=args.merge_gap, stats=stats, **output_options)
+        except FormatError as e:
+            print('cannot merge into %s: %s' % (args.output, e), file=sys.stderr)
+            return 1
+        for diagnostic in result['diagnostics']:
+            print(json.dumps(diagnostic), file=sys.stderr)
+        print('%d tracks merged into %s: %d points, %d duplicates dropped' % (
+            result['tracks'], args.output, result['points'], result['duplicates']))
+        if result['removed']:
+            print('%d points removed by simplification' % result['removed'])
+        if stats is not None:
+            print(json.dumps(stats.as_dict(), indent=1), file=sys.stderr)
+        return 0
+
+    batch = (len(args.input) > 1 or args.output_dir is not None or args.manifest is not None
+             or any(os.path.isdir(i) or glob.has_magic(i) or i.startswith('@') for i in args.input))
+    if not batch:
+        if args.output is None:
+            args.output = os.path.splitext(args.input[0])[0] + split_extension(args, args.input[0])
+        if args.jobs:
+            options['options'] = dict(output_options, jobs=args.jobs)
+        try:
+            q = alp2gpx(args.input[0], args.output, **options)
+        except FormatError as e:
+            print('%s: %s' % (args.input[0], e), file=sys.stderr)
+            return 1
+        print_diagnostics(args.input[0], q.diagnostics)
+        if q.removed:
+            print('%d points written, %d removed by simplification' % (q.points, q.removed), file=sys.stderr)
+        if q.stats is not None:
+            print(json.dumps(q.stats.as_dict(), indent=1), file=sys.stderr)
+        return 0
+
+    if args.output is not None:
+        parser.error('--output takes a single input, use --output-dir in batch mode')
+    start = time.perf_counter()
+    jobs = [(path, output_path(path, base, args.output_dir, split_extension(args, path)), options)
+            for path, base in find_inputs(args.input)]
+
+    manifest = None
+    if args.manifest is not None:
+        directory = args.output_dir
+        if directory is None:
+            # outputs go next to their inputs: keep the manifest with them, not in the working directory
+            try:
+                directory = os.path.commonpath([os.path.dirname(os.path.abspath(job[1])) for job in jobs])
+            except ValueError:      # no input, or outputs on different drives
+                directory = '.'
+        manifest = Manifest(args.manifest or os.path.join(directory, Manifest.filename))
+        todo = [job for job in jobs if not manifest.is_current(job[0], job[1], output_options)]
+        skipped = len(jobs) - len(todo)
+        jobs = todo
+
+    results = convert_batch(jobs, args.jobs, print_result)
+    if manifest is not None:
+        for r in results:
+            if r['ok']:
+                manifest.record(r['input'], r['output'], output_options, r['fingerprint'])
+        manifest.save()
+        print('%d files unchanged, skipped' % skipped)
+    print_summary(results, time.perf_counter() - start)
+    if args.stats:
+        total = Stats()
+        for r in results:
+            if r['stats']:
+                total.add(r['stats'])
+        report = total.as_dict()
+        report['files'] = len(results)
+        print(json.dumps(report, indent=1), file=sys.stderr)
+    return 1 if any(not r['ok'] for r in results) else 0
+
+
+def _timestamp(text):
+    # seconds since the epoch of an ISO 8601 date or time (UTC unless an offset is given)
+    value = datetime.fromisoformat(text.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        return (value - datetime(1970, 1, 1)).total_seconds()
+    return value.timestamp()
+
+
+def _isotime(ts):
+    # None for a missing time, and for a damaged one (NaN, out of range) as TimeFormatter._time
+    try:
+        return None if ts is None else datetime.utcfromtimestamp(ts).strftime("%Y-%m-%dT%H:%M:%SZ")
+    except (ValueError, OverflowError, OSError, TypeError):
+        return None
+
+
+class Catalog(object):
+    '''
+    SQLite catalog of a track store (alp2gpx.py catalog/query): for every
+    track (a .trk, or a trk entry of an .ldk) and every segment its
+    bounding box, time span and number of points, and for segments the
+    offset of their data in the .trk (the entry data for an .ldk), so a
+    matching segment is decoded without reading the rest of the file.
+    Bounding boxes and time spans are in R-trees (track_index,
+    segment_index), whose 32-bit bounds are rounded outwards; exact time
+    spans are checked in the segments table.
+    Updates are incremental: files with the same fingerprint as when they
+    were scanned are skipped, files gone from the disk are removed.
+    '''
+    filename = '.alp2gpx-catalog.sqlite'
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, '
+        'mtime_ns INTEGER, sha256 TEXT, converter TEXT, error TEXT)',
+        'CREATE TABLE IF NOT EXISTS tracks (id INTEGER PRIMARY KEY, file_id INTEGER, entry INTEGER, '
+        'entry_path TEXT, name TEXT, version INTEGER, points INTEGER, segments INTEGER, '
+        'min_lon REAL, max_lon REAL, min_lat REAL, max_lat REAL, min_ts REAL, max_ts REAL)',
+        'CREATE TABLE IF NOT EXISTS segments (id INTEGER PRIMARY KEY, track_id INTEGER, number INTEGER, '
+        'offset INTEGER, points INTEGER, min_lon REAL, max_lon REAL, min_lat REAL, max_lat REAL, '
+        'min_ts REAL, max_ts REAL)',
+        'CREATE INDEX IF NOT EXISTS tracks_file ON tracks (file_id)',
+        'CREATE INDEX IF NOT EXISTS segments_track ON segments (track_id)',
+        'CREATE VIRTUAL TABLE IF NOT EXISTS track_index USING rtree(id, min_lon, max_lon, '
+        'min_lat, max_lat, min_ts, max_ts)',
+        'CREATE VIRTUAL TABLE IF NOT EXISTS segment_index USING rtree(id, min_lon, max_lon, '
+        'min_lat, max_lat, min_ts, max_ts)',
+    )
+
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.db = sqlite3.connect(path)
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def _remove(self, file_id):
+        db = self.db
+        tracks = [row[0] for row in db.execute('SELECT id FROM tracks WHERE file_id = ?', (file_id,))]
+        for track in tracks:
+            db.execute('DELETE FROM segment_index WHERE id IN (SELECT id FROM segments WHERE track_id = ?)',
+                       (track,))
+            db.execute('DELETE FROM segments WHERE track_id = ?', (track,))
+            db.execute('DELETE FROM track_index WHERE id = ?', (track,))
+        db.execute('DELETE FROM tracks WHERE file_id = ?', (file_id,))
+        db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def is_current(self, path):
+        row = self.db.execute('SELECT id, size, mtime_ns, sha256, converter, error FROM files WHERE path = ?',
+                              (path,)).fetchone()
+        if row is None or row[4] != __version__ or row[5] is not None:
+            return False
+        stat = fingerprint(path, hashed=False)
+        if stat['size'] != row[1]:
+            return False
+        if stat['mtime_ns'] != row[2]:
+            # touched: same content means nothing to scan
+            if fingerprint(path)['sha256'] != row[3]:
+                return False
+            self.db.execute('UPDATE files SET mtime_ns = ? WHERE id = ?', (stat['mtime_ns'], row[0]))
+        return True
+
+    @staticmethod
+    def _bounds(box):
+        # R-tree bounds: points without time span all times, see query()
+        return box if box[4] is not None else box[:4] + (-1e30, 1e30)
+
+    def _add_track(self, file_id, q, entry=None):
+        # decode the track of q (header read), recording each segment
+        db = self.db
+        cursor = db.execute('INSERT INTO tracks (file_id, entry, entry_path, name, version) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (file_id, entry and entry['uuid'], entry and entry['path'],
+                             q.metadata.get('name'), q.fileVersion))
+        track = cursor.lastrowid
+        q._get_waypoints()
+        boxes, points, number = [], 0, 0
+        for number, (offset, segment) in enumerate(q._iter_located_segments(q.fileVersion)):
+            box = None
+            if len(segment):
+                times = [t for t in segment.ts if t == t]
+                box = (min(segment.lon), max(segment.lon), min(segment.lat), max(segment.lat),
+                       min(times) if times else None, max(times) if times else None)
+                boxes.append(box)
+            points += len(segment)
+            cursor = db.execute('INSERT INTO segments (track_id, number, offset, points, min_lon, max_lon, '
+                                'min_lat, max_lat, min_ts, max_ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                (track, number, offset, len(segment)) + (box or (None,) * 6))
+            if box:
+                db.execute('INSERT INTO segment_index VALUES (?, ?, ?, ?, ?, ?, ?)',
+                           (cursor.lastrowid,) + self._bounds(box))
+        box = (None,) * 6
+        if boxes:
+            box = tuple(f(b[i] for b in boxes if b[i] is not None) if any(b[i] is not None for b in boxes)
+                        else None for i, f in zip(range(6), (min, max) * 3))
+        db.execute('UPDATE tracks SET points = ?, segments = ?, min_lon = ?, max_lon = ?, min_lat = ?, '
+                   'max_lat = ?, min_ts = ?, max_ts = ? WHERE id = ?',
+                   (points, len(boxes) and number + 1) + box + (track,))
+        if boxes:
+            db.execute('INSERT INTO track_index VALUES (?, ?, ?, ?, ?, ?, ?)', (track,) + self._bounds(box))
+        return len(boxes)
+
+    def scan(self, path):
+        '''
+        (Re)index the tracks of path. Returns the number of tracks, or
+        None when the file is unchanged since it was scanned.
+        '''
+        path = os.path.abspath(path)
+        if self.is_current(path):
+            return None
+        row = self.db.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()
+        if row:
+            self._remove(row[0])
+        stamp = fingerprint(path)
+        file_id = self.db.execute('INSERT INTO files (path, size, mtime_ns, sha256, converter) '
+                                  'VALUES (?, ?, ?, ?, ?)', (path, stamp['size'], stamp['mtime_ns'],
+                                                             stamp['sha256'], __version__)).lastrowid
+        tracks = 0
+        try:
+            q = alp2gpx(path, None, convert=False)
+            if q.input_type() == 'ldk':
+                for entry in q.ldk_index().entries:
+                    if entry['type'] == 'trk':
+                        converter = q._entry(entry)
+                        converter.read_header()
+                        self._add_track(file_id, converter, entry)
+                        tracks += 1
+            else:
+                q.read_header()
+                self._add_track(file_id, q)
+                tracks += 1
+        except (Exception, SystemExit) as e:
+            # recorded, and the file scanned again on the next run
+            self.db.execute('UPDATE files SET error = ? WHERE id = ?', ('%s: %s' % (type(e).__name__, e), file_id))
+            raise
+        finally:
+            self.db.commit()
+        return tracks
+
+    def prune(self):
+        # remove the files gone from the disk, returns their number
+        gone = [(file_id, path) for file_id, path in self.db.execute('SELECT id, path FROM files')
+                if not os.path.exists(path)]
+        for file_id, path in gone:
+            self._remove(file_id)
+        self.db.commit()
+        return len(gone)
+
+    def query(self, bbox=None, start=None, end=None):
+        '''
+        Tracks with segments crossing bbox (min_lon, min_lat, max_lon,
+        max_lat) within the time range [start, end] (s, None: open): a list
+        of dicts with the track fields and its matching segments.
+        '''
+        conditions, values = [], []
+        if bbox is not None:
+            conditions += ['i.max_lon >= ?', 'i.min_lon <= ?', 'i.max_lat >= ?', 'i.min_lat <= ?']
+            values += [bbox[0], bbox[2], bbox[1], bbox[3]]
+        if start is not None:
+            conditions.append('i.max_ts >= ?')
+            values.append(start)
+        if end is not None:
+            conditions.append('i.min_ts <= ?')
+            values.append(end)
+        where = ' AND '.join(conditions) or '1'
+        tracks = set(row[0] for row in self.db.execute('SELECT id FROM track_index i WHERE ' + where, values))
+        columns = ('id', 'number', 'offset', 'points', 'min_lon', 'max_lon', 'min_lat', 'max_lat',
+                   'min_ts', 'max_ts')
+        matches = {}
+        for row in self.db.execute('SELECT s.track_id, %s FROM segment_index i JOIN segments s ON s.id = i.id '
+                                   'WHERE %s ORDER BY s.track_id, s.number'
+                                   % (', '.join('s.' + c for c in columns), where), values):
+            segment = dict(zip(columns, row[1:]))
+            # exact time bounds (the R-tree ones are rounded)
+            if row[0] not in tracks:
+                continue
+            if start is not None or end is not None:
+                if segment['min_ts'] is None or (start is not None and segment['max_ts'] < start) or \
+                        (end is not None and segment['min_ts'] > end):
+                    continue
+            matches.setdefault(row[0], []).append(segment)
+        result = []
+        columns = ('id', 'entry', 'entry_path', 'name', 'version', 'points', 'segments', 'min_lon',
+                   'max_lon', 'min_lat', 'max_lat', 'min_ts', 'max_ts')
+        for track_id in sorted(matches):
+            row = self.db.execute('SELECT f.path, f.size, f.mtime_ns, %s FROM tracks t JOIN files f '
+                                  'ON f.id = t.file_id WHERE t.id = ?' % ', '.join('t.' + c for c in columns),
+                                  (track_id,)).fetchone()
+            track = dict(zip(('file', 'size', 'mtime_ns') + columns, row))
+            track['matches'] = matches[track_id]
+            result.append(track)
+        return result
+
+    def read_segments(self, track):
+        '''
+        (metadata, [Segment]) of the matching segments of a track returned
+        by query(), decoded from their offsets. ValueError if the file
+        changed since it was scanned.
+        '''
+        stat = fingerprint(track['file'], hashed=False)
+        if (stat['size'], stat['mtime_ns']) != (track['size'], track['mtime_ns']):
+            raise ValueError('%s changed since it was cataloged, run catalog again' % track['file'])
+        q = alp2gpx(track['file'], None, convert=False)
+        if track['entry'] is not None:
+            entry = [e for e in q.ldk_index().entries if e['uuid'] == track['entry']][0]
+            q = q._entry(entry)
+        q.read_header()
+        return q.metadata, [q.segment_at(segment['offset']) for segment in track['matches']]
+
+
+def catalog(argv):
+    parser = argparse.ArgumentParser(prog='alp2gpx.py catalog',
+                                     description='index the tracks of a store (bounding boxes, time spans) for query')
+    parser.add_argument("input", nargs = '+',
+                        help = "input files (.trk, .ldk), directories, glob patterns or @listfile")
+    parser.add_argument("--db", default = Catalog.filename, help = "catalog file (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    store = Catalog(args.db)
+    scanned = unchanged = tracks = failed = 0
+    for path, base in find_inputs(args.input):
+        try:
+            n = store.scan(path)
+        except (Exception, SystemExit) as e:
+            print('  FAILED %s: %s: %s' % (path, type(e).__name__, e), file=sys.stderr)
+            failed += 1
+            continue
+        if n is None:
+            unchanged += 1
+        else:
+            scanned += 1
+            tracks += n
+    removed = store.prune()
+    store.close()
+    print('%d files scanned (%d tracks), %d unchanged, %d failed, %d removed in %.2fs' % (
+        scanned, tracks, unchanged, failed, removed, time.perf_counter() - start))
+    return 1 if failed else 0
+
+
+def query(argv):
+    parser = argparse.ArgumentParser(prog='alp2gpx.py query',
+                                     description='find the cataloged tracks crossing an area and/or a time range')
+    parser.add_argument("--db", default = Catalog.filename, help = "catalog file (default: %(default)s)")
+    parser.add_argument("--bbox", default = None, metavar = 'MINLON,MINLAT,MAXLON,MAXLAT')
+    parser.add_argument("--from", dest = 'start', default = None, metavar = 'TIME',
+                        help = "ISO 8601 date or time (UTC unless an offset is given)")
+    parser.add_argument("--to", dest = 'end', default = None, metavar = 'TIME')
+    parser.add_argument("--extract", action = 'store_true',
+                        help = "write the matching segments of each track (see -o, -d)")
+    parser.add_argument("-o", "--output", default = None, help = "extract: write all the matching segments to this file")
+    parser.add_argument("-d", "--output-dir", default = '.',
+                        help = "extract: directory of the outputs, one per track (default: current directory)")
+    parser.add_argument("-f", "--format", choices = sorted(WRITERS), default = 'gpx',
+                        help = "output format (default: gpx)")
+    args = parser.parse_args(argv)
+
+    bbox = None
+    if args.bbox:
+        bbox = [float(v) for v in args.bbox.split(',')]
+        if len(bbox) != 4:
+            parser.error('--bbox takes 4 values')
+    start = _timestamp(args.start) if args.start else None
+    end = _timestamp(args.end) if args.end else None
+    if end is not None and args.end and len(args.end) == 10:
+        end += 86399.999     # a date: up to its end
+    if not os.path.exists(args.db):
+        parser.error('no catalog %s, run alp2gpx.py catalog first' % args.db)
+    store = Catalog(args.db)
+    tracks = store.query(bbox, start, end)
+    store.close()
+
+    writer = None
+    status = 0
+    # one output per track: the catalogued paths (absolute) mirrored under
+    # the output directory from their common directory
+    root = None
+    if args.extract and not args.output and tracks:
+        root = os.path.commonpath([os.path.dirname(track['file']) for track in tracks])
+    written = set()
+    for track in tracks:
+        if not args.extract:
+            print(json.dumps({'file': track['file'], 'entry': track['entry_path'], 'name': track['name'],
+                              'points': track['points'], 'start': _isotime(track['min_ts']),
+                              'end': _isotime(track['max_ts']),
+                              'bbox': [track['min_lon'], track['min_lat'], track['max_lon'], track['max_lat']],
+                              'segments': [s['number'] for s in track['matches']]}))
+            continue
+        try:
+            metadata, segments = store.read_segments(track)
+        except (Exception, SystemExit) as e:
+            print('  FAILED %s: %s' % (track['file'], e), file=sys.stderr)
+            status = 1
+            continue
+        name = metadata.get('name') or os.path.splitext(os.path.basename(track['file']))[0]
+        if args.output:
+            if writer is None:
+                writer = WRITERS[args.format](args.output)
+                writer.begin('query', [])
+        else:
+            output = output_path(track['file'], root, args.output_dir, '')
+            if track['entry'] is not None:
+                output += '-%08X' % track['entry']
+            if output in written:
+                print('  FAILED %s: %s%s already written' % (track['file'], output, WRITERS[args.format].extension),
+                      file=sys.stderr)
+                status = 1
+                continue
+            written.add(output)
+            if os.path.dirname(output):
+                os.makedirs(os.path.dirname(output), exist_ok=True)
+            writer = WRITERS[args.format](output + WRITERS[args.format].extension)
+            writer.begin(name, [])
+        for segment in segments:
+            writer.segment(name, segment)
+        if not args.output:
+            writer.end()
+            print('%d segments, %d pts  %s -> %s' % (len(segments), sum(len(s) for s in segments),
+                                                     track['file'], writer.path))
+    if args.output and writer is not None:
+        writer.end()
+        print('%d tracks -> %s' % (len(tracks), args.output))
+    return status
+
+
+def serve_convert(data, options):
+    # worker side of the daemon: convert an uploaded file held in memory
+    output = io.BytesIO()
+    q = alp2gpx(data, output, convert=False, options=options)
+    q.convert()
+    return output.getvalue(), q.points, q.diagnostics
+
+
+def _warm_up():
+    # run in each worker when the server starts, so it is forked and ready
+    return os.getpid()
+
+
+def _percentile(values, percent):
+    # nearest rank percentile of sorted values
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * percent / 100.0))]
+
+
+class ConversionServer(object):
+    '''
+    Conversion daemon (alp2gpx.py serve): a minimal asyncio HTTP/1.1
+    server on a TCP port or a Unix socket. Conversions run in a pool of
+    worker processes started and warmed up with the server, so a request
+    pays neither the interpreter startup nor the imports.
+
+        POST /convert?format=gpx&precision=6&ele_precision=1&milliseconds=1&statistics=1&tolerance=5
+            body: content of a .trk or .ldk file (the simplification
+            parameters are those of Simplifier)
+            -> 200 with the converted output, 422 if it cannot be converted;
+            with partial=1 the damaged parts skipped are counted in
+            X-Alp2gpx-Diagnostics-Count, the first header_diagnostics of
+            them listed (JSON) in X-Alp2gpx-Diagnostics
+        GET /metrics
+            -> JSON: requests, queue depth, latency percentiles (ms)
+
+    The latency of a request is measured from its body being received to
+    its response being written; the last history requests are kept.
+    '''
+    chunk_size = 1 << 20
+    header_diagnostics = 20     # listed in the response header, at most
+
+    def __init__(self, workers=None, max_size=256 << 20, history=1000):
+        import collections
+        import concurrent.futures
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.workers)
+        self.max_size = max_size
+        self.latencies = collections.deque(maxlen=history)
+        self.pending = 0        # submitted to the pool, not completed
+        self.requests = 0
+        self.failed = 0
+        self.points = 0
+        self.started = time.time()
+
+    def metrics(self):
+        latencies = sorted(self.latencies)
+        result = {'workers': self.workers, 'uptime': time.time() - self.started,
+                  'requests': self.requests, 'failed': self.failed, 'points': self.points,
+                  'in_flight': self.pending, 'queue_depth': max(0, self.pending - self.workers)}
+        for percent in (50, 90, 99):
+            value = _percentile(latencies, percent)
+            result['latency_p%d_ms' % percent] = None if value is None else value * 1e3
+        return result
+
+    def _options(self, query):
+        # writer options of the query string, ValueError if invalid
+        from urllib.parse import parse_qs
+        values = dict((k, v[-1]) for k, v in parse_qs(query).items())
+        options = {'format': values.pop('format', 'gpx')}
+        if options['format'] not in WRITERS:
+            raise ValueError('unknown format %s' % options['format'])
+        for name in ('precision', 'ele_precision'):
+            if name in values:
+                options[name] = int(values.pop(name))
+        for name in ('milliseconds', 'statistics', 'partial'):
+            if values.pop(name, '0') not in ('', '0', 'false'):
+                options[name] = True
+        simplify = dict((key, float(values.pop(key))) for key in list(values)
+                        if key in ('tolerance', 'min_distance', 'min_time', 'stationary', 'stationary_time'))
+        if simplify:
+            options['simplify'] = simplify
+        if values:
+            raise ValueError('unknown parameters %s' % ', '.join(sorted(values)))
+        return options
+
+    async def _respond(self, writer, status, body, content_type='text/plain; charset=utf-8', extra=()):
+        reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                   411: 'Length Required', 413: 'Payload Too Large', 422: 'Unprocessable Entity'}
+        if isinstance(body, str):
+            body = (body + '\n').encode('utf-8')
+        head = ['HTTP/1.1 %d %s' % (status, reasons[status]), 'Content-Type: %s' % content_type,
+                'Content-Length: %d' % len(body)] + list(extra)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1'))
+        view = memoryview(body)
+        for start in range(0, len(view), self.chunk_size):
+            writer.write(view[start:start + self.chunk_size])
+            await writer.drain()
+        await writer.drain()
+
+    async def _convert(self, writer, query, data):
+        import asyncio
+        try:
+            options = self._options(query)
+        except ValueError as e:
+            return await self._respond(writer, 400, str(e))
+        start = time.perf_counter()
+        self.pending += 1
+        self.requests += 1
+        try:
+            output, points, diagnostics = await asyncio.get_running_loop().run_in_executor(
+                self.pool, serve_convert, bytes(data), options)
+        except (Exception, SystemExit) as e:
+            self.failed += 1
+            return await self._respond(writer, 422, '%s: %s' % (type(e).__name__, e))
+        finally:
+            self.pending -= 1
+        self.points += points
+        writer_class = WRITERS[options['format']]
+        extra = ['X-Alp2gpx-Points: %d' % points]
+        if diagnostics:
+            # bounded: http.client refuses header lines over 64 KiB
+            extra.append('X-Alp2gpx-Diagnostics-Count: %d' % len(diagnostics))
+            extra.append('X-Alp2gpx-Diagnostics: %s' % json.dumps(diagnostics[:self.header_diagnostics]))
+        await self._respond(writer, 200, output, writer_class.media_type, extra)
+        self.latencies.append(time.perf_counter() - start)
+
+    async def handle(self, reader, writer):
+        # one connection, with keep-alive
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode('latin-1').split()
+                except ValueError:
+                    await self._respond(writer, 400, 'bad request line')
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                path, _, query = target.partition('?')
+                length = headers.get('content-length')
+                if length is not None:
+                    try:
+                        length = int(length)
+                        if length < 0:
+                            raise ValueError(length)
+                    except ValueError:
+                        await self._respond(writer, 400, 'bad Content-Length')
+                        break
+                if length is not None and length > self.max_size:
+                    await self._respond(writer, 413, 'file larger than %d bytes' % self.max_size)
+                    break
+                data = await reader.readexactly(length) if length else b''
+                if path == '/metrics' and method == 'GET':
+                    await self._respond(writer, 200, json.dumps(self.metrics()), 'application/json')
+                elif path == '/convert' and method == 'POST':
+                    if length is None:
+                        await self._respond(writer, 411, 'Content-Length required')
+                        break
+                    await self._convert(writer, query, data)
+                elif path in ('/metrics', '/convert'):
+                    await self._respond(writer, 405, 'method not allowed')
+                else:
+                    await self._respond(writer, 404, 'not found')
+                if headers.get('connection', '').lower() == 'close' or version == 'HTTP/1.0':
+                    break
+        except (ConnectionError, EOFError):
+            pass
+        finally:
+            writer.close()
+
+    async def run(self, host='127.0.0.1', port=8750, path=None, ready=None):
+        '''
+        Start the workers, then serve on path (a Unix socket) or host:port
+        until cancelled. ready is called with the listening address.
+        '''
+        import asyncio
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[loop.run_in_executor(self.pool, _warm_up) for i in range(self.workers)])
+        if path:
+            server = await asyncio.start_unix_server(self.handle, path)
+            address = path
+        else:
+            server = await asyncio.start_server(self.handle, host, port)
+            address = '%s:%d' % server.sockets[0].getsockname()[:2]
+        if ready:
+            ready(address)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.shutdown()
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+
+def serve(argv):
+    parser = argparse.ArgumentParser(prog='alp2gpx.py serve',
+                                     description='conversion daemon with a pool of worker processes')
+    parser.add_argument("--host", default = '127.0.0.1', help = "address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", type = int, default = 8750, help = "TCP port (default: 8750, 0: any free port)")
+    parser.add_argument("--socket", default = None, help = "listen on this Unix socket instead of TCP")
+    parser.add_argument("-j", "--jobs", type = int, default = None,
+                        help = "number of worker processes (default: number of CPUs)")
+    parser.add_argument("--max-size", type = int, default = 256,
+                        help = "largest accepted upload, in MB (default: 256)")
+    args = parser.parse_args(argv)
+
+    import asyncio
+    import signal
+    server = ConversionServer(args.jobs, args.max_size << 20)
+
+    def ready(address):
+        print('alp2gpx %s serving on %s with %d workers' % (__version__, address, server.workers),
+              file=sys.stderr, flush=True)
+
+    async def main():
+        task = asyncio.ensure_future(server.run(args.host, args.port, args.socket, ready))
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, task.cancel)
+        except (NotImplementedError, AttributeError):     # not on Windows
+            pass
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def connect(url=None, socket_path=None):
+    # http.client connection to a conversion daemon, over TCP or a Unix socket
+    import http.client
+    import socket
+    from urllib.parse import urlsplit
+    if socket_path:
+        connection = http.client.HTTPConnection('localhost')
+
+        def connect_unix():
+            connection.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            connection.sock.connect(socket_path)
+        connection.connect = connect_unix
+        return connection
+    parts = urlsplit(url or 'http://127.0.0.1:8750')
+    return http.client.HTTPConnection(parts.hostname, parts.port or 80)
+
+
+def client(argv):
+    parser = argparse.ArgumentParser(prog='alp2gpx.py client',
+                                     description='convert files through a running conversion daemon')
+    parser.add_argument("input", nargs = '*',
+                        help = "input files (.trk, .ldk), directories, glob patterns or @listfile")
+    parser.add_argument("--url", default = 'http://127.0.0.1:8750', help = "server URL (default: %(default)s)")
+    parser.add_argument("--socket", default = None, help = "connect to this Unix socket instead")
+    parser.add_argument("-o", "--output", default = None, help = "output file (single input)")
+    parser.add_argument("-d", "--output-dir", default = None,
+                        help = "write outputs to a tree mirroring the inputs under this directory")
+    parser.add_argument("-f", "--format", choices = sorted(WRITERS), default = 'gpx',
+                        help = "output format (default: gpx)")
+    parser.add_argument("--precision", type = int, default = None)
+    parser.add_argument("--ele-precision", type = int, default = None)
+    parser.add_argument("--milliseconds", action = 'store_true')
+    parser.add_argument("--statistics", action = 'store_true')
+    parser.add_argument("--partial", action = 'store_true')
+    add_simplify_arguments(parser)
+    parser.add_argument("--metrics", action = 'store_true', help = "print the server metrics (JSON)")
+    args = parser.parse_args(argv)
+
+    from urllib.parse import urlencode
+    connection = connect(args.url, args.socket)
+    if args.metrics:
+        connection.request('GET', '/metrics')
+        print(connection.getresponse().read().decode('utf-8').strip())
+    query = {'format': args.format}
+    for name in ('precision', 'ele_precision'):
+        if getattr(args, name) is not None:
+            query[name] = getattr(args, name)
+    for name in ('milliseconds', 'statistics', 'partial'):
+        if getattr(args, name):
+            query[name] = 1
+    query.update(simplify_options(args) or {})
+    inputs = list(find_inputs(args.input))
+    if args.output is not None and len(inputs) != 1:
+        parser.error('--output takes a single input, use --output-dir')
+    status = 0
+    for path, base in inputs:
+        start = time.perf_counter()
+        result = {'input': path, 'ok': False, 'points': 0, 'error': None,
+                  'output': args.output or output_path(path, base, args.output_dir, WRITERS[args.format].extension)}
+        with open(path, 'rb') as f:
+            connection.request('POST', '/convert?' + urlencode(query), f.read())
+        response = connection.getresponse()
+        body = response.read()
+        if response.status == 200:
+            directory = os.path.dirname(result['output'])
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(result['output'], 'wb') as f:
+                f.write(body)
+            result['ok'] = True
+            result['points'] = int(response.getheader('X-Alp2gpx-Points', 0))
+            result['diagnostics'] = json.loads(response.getheader('X-Alp2gpx-Diagnostics', '[]'))
+            more = int(response.getheader('X-Alp2gpx-Diagnostics-Count', 0)) - len(result['diagnostics'])
+            if more > 0:
+                result['diagnostics'].append({'field': 'diagnostics', 'reason': '%d more not listed' % more})
+        else:
+            result['error'] = '%d %s' % (response.status, body.decode('utf-8', 'replace').strip())
+            status = 1
+        result['seconds'] = time.perf_counter() - start
+        print_result(result)
+    connection.close()
+    return status
+
+
+# sub-commands, given as the first argument
+COMMANDS = {'serve': serve, 'client': client, 'catalog': catalog, 'query': query}
+
+
+if __name__ == "__main__":
+    sys.exit(main())
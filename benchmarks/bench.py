@@ -0,0 +1,556 @@
+#!/usr/bin/env python3
+'''
+Benchmarks of the converter on synthetic files (see synth.py).
+
+Each measurement runs in a fresh process and reports points/s, MB/s
+(input read for parse_* and statistics, GPX written for write_xml; the
+statistics phase times TrackStatistics alone) and the peak RSS of
+that process; the import time of alp2gpx and the memory used per decoded
+point are reported too, and the output formats are compared on the same
+track (size, write time, time to read the output back). Each .trk is
+also decoded once under tracemalloc with statistics on: bytes allocated
+(peak, and still held once decoded), decoding calls
+on the Reader (Stats reads) and read system calls of the process (syscr
+of /proc/self/io, where there is one). Results can be saved as JSON and compared with a previous run to track regressions:
+
+    python bench.py --points 200000 --json before.json
+    python bench.py --points 200000 --compare before.json
+
+--serve N compares the time per file of N small conversions run one CLI
+process each with the same conversions sent to the conversion daemon.
+--decode-jobs N times the decoding of one large .trk by 1 to N processes
+(pre-scan of the segments, then pieces decoded in parallel).
+--memory N converts a one-segment track of N points to every format
+through convert(), each in a fresh process, and fails when the peak RSS
+grows by more than --memory-bound MB over that of the import: the
+writers stream, so it must not depend on N.
+--fuzz N converts N damaged copies (synth.damage, seeds 0 to N-1, even
+seeds cut, odd ones corrupted) of each case, strict and with the partial
+option, each in its own process: FormatError raised, share of the points
+kept, diagnostics and worst time are reported. It fails (exit status 1)
+on any other exception, on a file taking more than --fuzz-seconds, and in
+partial mode on a FormatError (but for a damaged .trk header, from which
+nothing can be decoded) or a cut file converted without diagnostics.
+'''
+
+import os
+import sys
+import json
+import time
+import zipfile
+import tempfile
+import argparse
+import subprocess
+import tracemalloc
+import multiprocessing
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+import synth
+
+try:
+    import resource
+except ImportError:     # not on Windows
+    resource = None
+
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+
+
+def _decode_trk(q):
+    # decode a whole .trk without writing anything, returns the number of points
+    q.read_header()
+    q._get_waypoints()
+    return sum(len(s) for s in q._iter_segments(q.fileVersion))
+
+
+def _measure(phase, path, queue):
+    import alp2gpx
+    result = {'bytes': os.path.getsize(path)}
+    if phase == 'parse_trk':
+        start = time.perf_counter()
+        result['points'] = _decode_trk(alp2gpx.alp2gpx(path, None, convert=False))
+    elif phase == 'parse_ldk':
+        start = time.perf_counter()
+        q = alp2gpx.alp2gpx(path, None, convert=False)
+        points = 0
+        # every entry type, in one walk of the archive
+        for entry, track in q.ldk_contents():
+            points += sum(len(s) for s in track.segments) + len(track.waypoints)
+        result['points'] = points
+    elif phase == 'write_xml':
+        output = tempfile.NamedTemporaryFile(suffix='.gpx', delete=False).name
+        q = alp2gpx.alp2gpx(path, output, convert=False)
+        q.read_header()
+        waypoints = q._get_waypoints()
+        q.track = alp2gpx.Track(q.fileVersion, q.metadata, waypoints, q._get_segments(q.fileVersion))
+        start = time.perf_counter()
+        q.write_xml()
+        result['points'] = q.points
+        result['bytes'] = os.path.getsize(output)
+        os.unlink(output)
+    elif phase == 'statistics':
+        q = alp2gpx.alp2gpx(path, None, convert=False)
+        q.read_header()
+        q._get_waypoints()
+        segments = q._get_segments(q.fileVersion)
+        start = time.perf_counter()
+        statistics = alp2gpx.TrackStatistics()
+        for segment in segments:
+            statistics.add(segment)
+        result['points'] = statistics.as_dict()['points']
+    result['seconds'] = time.perf_counter() - start
+    result['peak_rss_mb'] = _peak_rss_mb()
+    queue.put(result)
+
+
+def _read_syscalls():
+    # read(2)-like calls of this process so far, None where not available
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('syscr:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def _measure_io(phase, path, queue):
+    # allocations and read calls of decoding a whole .trk
+    import alp2gpx
+    q = alp2gpx.alp2gpx(path, None, convert=False, stats=True)
+    syscalls = _read_syscalls()
+    tracemalloc.start()
+    points = _decode_trk(q)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if syscalls is not None:
+        syscalls = _read_syscalls() - syscalls
+    queue.put({'points': points, 'bytes': os.path.getsize(path), 'alloc_peak': peak,
+               'alloc_retained': retained, 'reads': q.stats.reads,
+               'bytes_read': q.stats.bytes_read, 'read_syscalls': syscalls})
+
+
+def _measure_memory(format, path, queue):
+    # peak RSS of a convert() of path to format, over the peak after the import
+    import alp2gpx
+    before = _peak_rss_mb()
+    output = path + '.' + format
+    start = time.perf_counter()
+    points = alp2gpx.convert(path, output, format=format)
+    result = {'format': format, 'points': points, 'seconds': time.perf_counter() - start,
+              'import_rss_mb': before, 'peak_rss_mb': _peak_rss_mb()}
+    os.unlink(output)
+    queue.put(result)
+
+
+def streaming_memory(points, bound_mb):
+    # peak RSS growth converting one segment of points to each format
+    path = tempfile.NamedTemporaryFile(suffix='.trk', delete=False).name
+    # written by another process: the peak RSS of this one, inherited by the
+    # measuring processes, stays that of the import
+    subprocess.run([sys.executable, os.path.join(HERE, 'synth.py'), 'trk', '--points', str(points), path],
+                   check=True)
+    results = []
+    for format in ('gpx', 'geojson', 'csv', 'npz'):
+        r = measure(format, path, _measure_memory)
+        r['growth_mb'] = r['peak_rss_mb'] - r['import_rss_mb']
+        r['ok'] = r['growth_mb'] <= bound_mb
+        results.append(r)
+    os.unlink(path)
+    return results
+
+
+def _read_npz(path):
+    # numpy.load when available, else the .npy headers are skipped by hand
+    try:
+        import numpy
+    except ImportError:
+        from array import array
+        with zipfile.ZipFile(path) as z:
+            for name in z.namelist():
+                data = z.read(name)
+                header = 10 + int.from_bytes(data[8:10], 'little')
+                if b"'<f8'" in data[:header] or b"'>f8'" in data[:header]:
+                    array('d').frombytes(data[header:])
+        return
+    with numpy.load(path) as z:
+        for name in z.files:
+            z[name]
+
+
+def _read_csv(path):
+    import csv
+    with open(path, newline='') as f:
+        for row in csv.reader(f):
+            pass
+
+
+def _read_geojson(path):
+    with open(path) as f:
+        json.load(f)
+
+
+def _read_gpx(path):
+    import xml.etree.ElementTree as ET
+    ET.parse(path)
+
+
+def _measure_format(format, path, queue):
+    # write the decoded track in format, then read the output back
+    import alp2gpx
+    writer = alp2gpx.WRITERS[format]
+    output = tempfile.NamedTemporaryFile(suffix=writer.extension, delete=False).name
+    q = alp2gpx.alp2gpx(path, output, convert=False, options={'format': format})
+    q.read_header()
+    waypoints = q._get_waypoints()
+    q.track = alp2gpx.Track(q.fileVersion, q.metadata, waypoints, q._get_segments(q.fileVersion))
+    start = time.perf_counter()
+    q.write_xml()
+    result = {'points': q.points, 'bytes': os.path.getsize(output),
+              'write_seconds': time.perf_counter() - start}
+    start = time.perf_counter()
+    globals()['_read_' + format](output)
+    result['read_seconds'] = time.perf_counter() - start
+    os.unlink(output)
+    queue.put(result)
+
+
+def measure(phase, path, target=_measure):
+    # run one measurement in a fresh interpreter, so peak RSS is its own
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    process = ctx.Process(target=target, args=(phase, path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def import_time(repeat=5):
+    # best wall time of "import alp2gpx" minus an empty interpreter start
+    def best(code):
+        times = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(HERE), check=True)
+            times.append(time.perf_counter() - start)
+        return min(times)
+    return max(0.0, best('import alp2gpx') - best('pass'))
+
+
+def bytes_per_point(path):
+    # memory held by decoded Segments, per point
+    import alp2gpx
+    q = alp2gpx.alp2gpx(path, None, convert=False)
+    q.read_header()
+    q._get_waypoints()
+    tracemalloc.start()
+    segments = q._get_segments(q.fileVersion)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size / max(1, sum(len(s) for s in segments))
+
+
+def serve_vs_cli(files, points=500):
+    # seconds per file: one CLI process per file, then through a daemon on localhost
+    script = os.path.join(os.path.dirname(HERE), 'alp2gpx.py')
+    tmp = tempfile.mkdtemp()
+    paths = []
+    for i in range(files):
+        paths.append(os.path.join(tmp, 'small%d.trk' % i))
+        with open(paths[-1], 'wb') as f:
+            f.write(synth.trk(3, points=points, seed=i))
+    start = time.perf_counter()
+    for path in paths:
+        subprocess.run([sys.executable, script, path], check=True, stdout=subprocess.DEVNULL)
+    cli = (time.perf_counter() - start) / files
+
+    server = subprocess.Popen([sys.executable, script, 'serve', '--port', '0', '-j', '2'],
+                              stderr=subprocess.PIPE, universal_newlines=True)
+    try:
+        address = server.stderr.readline().split(' serving on ')[1].split()[0]
+        import alp2gpx
+        connection = alp2gpx.connect('http://' + address)
+        start = time.perf_counter()
+        for path in paths:
+            with open(path, 'rb') as f:
+                connection.request('POST', '/convert', f.read())
+            response = connection.getresponse()
+            with open(os.path.splitext(path)[0] + '.gpx', 'wb') as f:
+                f.write(response.read())
+        daemon = (time.perf_counter() - start) / files
+        connection.request('GET', '/metrics')
+        metrics = json.loads(connection.getresponse().read())
+        connection.close()
+    finally:
+        server.terminate()
+        server.wait()
+    for name in os.listdir(tmp):
+        os.unlink(os.path.join(tmp, name))
+    os.rmdir(tmp)
+    return {'files': files, 'points': points, 'cli_seconds': cli, 'daemon_seconds': daemon,
+            'daemon_metrics': metrics}
+
+
+def decode_scaling(points, segments, max_jobs):
+    # seconds to decode every segment of one .trk by 1 (sequential) to max_jobs processes
+    import alp2gpx
+    path = tempfile.NamedTemporaryFile(suffix='.trk', delete=False).name
+    with open(path, 'wb') as f:
+        f.write(synth.trk(3, points=max(1, points // segments), segments=segments))
+    results = []
+    for jobs in range(1, max_jobs + 1):
+        start = time.perf_counter()
+        track = alp2gpx.alp2gpx(path, None, convert=False, options={'jobs': jobs}).read_track()
+        decoded = sum(len(segment) for segment in track.segments)
+        results.append({'jobs': jobs, 'points': decoded, 'seconds': time.perf_counter() - start})
+    os.unlink(path)
+    return results
+
+
+def _header_damaged(alp2gpx, path):
+    # whether the header of a .trk (or of an .ldk archive) cannot be read
+    q = alp2gpx.alp2gpx(path, None, convert=False)
+    try:
+        if q.input_type() == 'trk':
+            q.read_header()
+        elif q.inputfile.size < 0x30:
+            return True
+    except alp2gpx.FormatError:
+        return True
+    return False
+
+
+def _convert_damaged(path, partial):
+    # convert one damaged file and print the outcome as JSON (child process of damaged())
+    import alp2gpx
+    result = {'points': 0, 'diagnostics': 0, 'error': None, 'header': False}
+    start = time.perf_counter()
+    try:
+        q = alp2gpx.alp2gpx(path, path + '.gpx', options={'partial': partial})
+        result['points'], result['diagnostics'] = q.points, len(q.diagnostics)
+    except alp2gpx.FormatError:
+        result['error'] = 'FormatError'
+        result['header'] = _header_damaged(alp2gpx, path)
+    except Exception as e:
+        result['error'] = '%s: %s' % (type(e).__name__, e)
+    result['seconds'] = time.perf_counter() - start
+    print(json.dumps(result))
+
+
+def _damage_failure(outcome, mode, cut, seconds):
+    # what is wrong with the outcome of a damaged file, None if nothing
+    if outcome['error'] not in (None, 'FormatError'):
+        return outcome['error']
+    if outcome['seconds'] > seconds:
+        return '%.1f s, more than %.1f s' % (outcome['seconds'], seconds)
+    if mode == 'partial' and not outcome['header']:
+        if outcome['error']:
+            return 'FormatError in partial mode'
+        if cut and not outcome['diagnostics']:
+            return 'cut without diagnostics'
+    return None
+
+
+def damaged(points, files, seconds=10.0):
+    # outcome of converting files damaged copies of each case, strict then partial
+    code = 'import sys, bench; bench._convert_damaged(sys.argv[1], sys.argv[2] == "partial")'
+
+    def convert(path, mode):
+        try:
+            run = subprocess.run([sys.executable, '-c', code, path, mode], cwd=HERE, timeout=seconds + 30,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        except subprocess.TimeoutExpired:
+            return {'points': 0, 'diagnostics': 0, 'error': 'timeout', 'header': False, 'seconds': seconds}
+        if run.returncode:
+            return {'points': 0, 'diagnostics': 0, 'error': run.stderr.strip().splitlines()[-1],
+                    'header': False, 'seconds': 0.0}
+        return json.loads(run.stdout)
+
+    tmp = tempfile.mkdtemp()
+    results = []
+    for name, kind, options in cases(points, 2):
+        data = getattr(synth, kind)(**options)
+        path = os.path.join(tmp, 'damaged.' + kind)
+        with open(path, 'wb') as f:
+            f.write(data)
+        intact = convert(path, 'strict')['points']
+        runs = {mode: {'case': name, 'mode': mode, 'files': files, 'raised': 0, 'points': 0,
+                       'intact_points': intact * files, 'diagnostics': 0, 'max_seconds': 0.0,
+                       'failures': []} for mode in ('strict', 'partial')}
+        for seed in range(files):
+            cut = seed % 2 == 0
+            with open(path, 'wb') as f:
+                f.write(synth.damage(data, seed, cut=cut))
+            for mode, r in runs.items():
+                outcome = convert(path, mode)
+                r['points'] += outcome['points']
+                r['diagnostics'] += outcome['diagnostics']
+                r['max_seconds'] = max(r['max_seconds'], outcome['seconds'])
+                if outcome['error'] == 'FormatError':
+                    r['raised'] += 1
+                failure = _damage_failure(outcome, mode, cut, seconds)
+                if failure:
+                    r['failures'].append({'seed': seed, 'error': failure})
+        results.extend(runs.values())
+    for name in os.listdir(tmp):
+        os.unlink(os.path.join(tmp, name))
+    os.rmdir(tmp)
+    return results
+
+
+def cases(points, segments):
+    per_segment = max(1, points // segments)
+    yield 'trk v2', 'trk', dict(version=2, points=per_segment, segments=segments, extra=0)
+    yield 'trk v3', 'trk', dict(version=3, points=per_segment, segments=segments, extra=2)
+    yield 'trk v3 mixed', 'trk', dict(version=3, points=per_segment, segments=segments, mixed=True)
+    yield 'trk v4', 'trk', dict(version=4, points=per_segment, segments=segments)
+    # depth 3, fanout 2: 15 folders of 2 trk entries and a wpt, set, rte and are
+    yield 'ldk', 'ldk', dict(depth=3, fanout=2, entries=2, blocks=3, points=max(1, points // 30),
+                             kinds=('wpt', 'set', 'rte', 'are'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark alp2gpx on synthetic files')
+    parser.add_argument('--points', type=int, default=200000, help='points per file')
+    parser.add_argument('--segments', type=int, default=4, help='segments per .trk')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='compare with results saved by --json')
+    parser.add_argument('--serve', type=int, metavar='N', default=0,
+                        help='also compare N small conversions by CLI and by the daemon')
+    parser.add_argument('--decode-jobs', type=int, metavar='N', default=0,
+                        help='also time the decoding of one .trk of 5x --points by 1 to N processes')
+    parser.add_argument('--memory', type=int, metavar='N', default=0,
+                        help='only check the peak RSS of converting a one-segment track of N points')
+    parser.add_argument('--memory-bound', type=float, metavar='MB', default=64.0,
+                        help='largest peak RSS growth over the import accepted by --memory (default: 64)')
+    parser.add_argument('--fuzz', type=int, metavar='N', default=0,
+                        help='only convert N damaged copies of each case (of at most 5000 points)')
+    parser.add_argument('--fuzz-seconds', type=float, metavar='S', default=10.0,
+                        help='longest conversion of a damaged file accepted by --fuzz (default: 10)')
+    args = parser.parse_args(argv)
+
+    if args.memory:
+        if resource is None:
+            parser.error('--memory needs the resource module (not on Windows)')
+        runs = streaming_memory(args.memory, args.memory_bound)
+        print('%-8s %9s %8s %10s %9s %10s' % ('format', 'points', 'seconds', 'import MB', 'peak MB', 'growth MB'))
+        for r in runs:
+            print('%-8s %9d %8.1f %10.1f %9.1f %10.1f%s' % (r['format'], r['points'], r['seconds'],
+                  r['import_rss_mb'], r['peak_rss_mb'], r['growth_mb'],
+                  '' if r['ok'] else '  FAILED: over %.0f MB' % args.memory_bound))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'memory': runs}, f, indent=1)
+        return 0 if all(r['ok'] for r in runs) else 1
+
+    if args.fuzz:
+        runs = damaged(min(args.points, 5000), args.fuzz, args.fuzz_seconds)
+        print('%-14s %-8s %6s %7s %8s %11s %8s' % ('case', 'mode', 'files', 'raised', 'kept %',
+                                                   'diagnostics', 'max s'))
+        for r in runs:
+            print('%-14s %-8s %6d %7d %8.1f %11d %8.3f' % (r['case'], r['mode'], r['files'], r['raised'],
+                  100.0 * r['points'] / r['intact_points'] if r['intact_points'] else 0.0,
+                  r['diagnostics'], r['max_seconds']))
+            for failure in r['failures']:
+                print('  FAILED seed %d: %s' % (failure['seed'], failure['error']))
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'fuzz': runs}, f, indent=1)
+        return 1 if any(r['failures'] for r in runs) else 0
+
+    results = {'import_seconds': import_time(), 'runs': []}
+    print('import alp2gpx: %.1f ms' % (results['import_seconds'] * 1e3))
+    print('%-14s %-10s %9s %8s %12s %8s %9s' % ('case', 'phase', 'points', 'seconds',
+                                                'points/s', 'MB/s', 'peak MB'))
+    tmp = tempfile.mkdtemp()
+    for name, kind, options in cases(args.points, args.segments):
+        path = os.path.join(tmp, name.replace(' ', '_') + '.' + kind)
+        with open(path, 'wb') as f:
+            f.write(getattr(synth, kind)(**options))
+        phases = ('parse_trk', 'write_xml', 'statistics') if kind == 'trk' else ('parse_ldk',)
+        for phase in phases:
+            r = measure(phase, path)
+            r.update({'case': name, 'phase': phase})
+            r['points_per_s'] = r['points'] / r['seconds'] if r['seconds'] else 0.0
+            r['mb_per_s'] = r['bytes'] / 1e6 / r['seconds'] if r['seconds'] else 0.0
+            results['runs'].append(r)
+            print('%-14s %-10s %9d %8.3f %12.0f %8.1f %9.1f' % (name, phase, r['points'], r['seconds'],
+                  r['points_per_s'], r['mb_per_s'], r['peak_rss_mb'] or 0))
+        if kind == 'trk':
+            results.setdefault('bytes_per_point', {})[name] = bytes_per_point(path)
+            results.setdefault('io', {})[name] = measure('decode', path, _measure_io)
+        if name == 'trk v3':
+            formats = results['formats'] = {}
+            for format in ('gpx', 'geojson', 'csv', 'npz'):
+                formats[format] = measure(format, path, _measure_format)
+        os.unlink(path)
+    os.rmdir(tmp)
+    for name, size in sorted(results.get('bytes_per_point', {}).items()):
+        print('%-14s %.1f bytes per decoded point' % (name, size))
+    print('\n%-14s %9s %13s %13s %11s %13s' % ('case', 'points', 'alloc peak MB', 'retained MB',
+                                              'reads', 'read syscalls'))
+    for name, r in results['io'].items():
+        print('%-14s %9d %13.1f %13.1f %11d %13s' % (name, r['points'], r['alloc_peak'] / 1e6,
+              r['alloc_retained'] / 1e6, r['reads'],
+              '-' if r['read_syscalls'] is None else r['read_syscalls']))
+    print('\n%-8s %9s %10s %8s %12s' % ('format', 'MB', 'write s', 'read s', 'points/s'))
+    for format, r in results['formats'].items():
+        print('%-8s %9.2f %10.3f %8.3f %12.0f' % (format, r['bytes'] / 1e6, r['write_seconds'],
+              r['read_seconds'], r['points'] / r['write_seconds'] if r['write_seconds'] else 0))
+
+    if args.serve:
+        r = results['serve'] = serve_vs_cli(args.serve)
+        print('\n%d files of %d points: %.1f ms per file by CLI, %.1f ms through the daemon'
+              ' (p50 %.1f ms, p99 %.1f ms)' % (r['files'], r['points'], r['cli_seconds'] * 1e3,
+              r['daemon_seconds'] * 1e3, r['daemon_metrics']['latency_p50_ms'],
+              r['daemon_metrics']['latency_p99_ms']))
+
+    if args.decode_jobs:
+        runs = results['decode_scaling'] = decode_scaling(5 * args.points, 4 * args.segments,
+                                                          args.decode_jobs)
+        print('\n%-5s %9s %8s %12s %8s' % ('jobs', 'points', 'seconds', 'points/s', 'speedup'))
+        for r in runs:
+            print('%-5d %9d %8.3f %12.0f %7.2fx' % (r['jobs'], r['points'], r['seconds'],
+                  r['points'] / r['seconds'], runs[0]['seconds'] / r['seconds']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            before = dict(((r['case'], r['phase']), r) for r in json.load(f)['runs'])
+        print('\nspeed relative to %s (>1 is faster)' % args.compare)
+        for r in results['runs']:
+            old = before.get((r['case'], r['phase']))
+            if old and old['points_per_s']:
+                print('%-14s %-10s %6.2fx' % (r['case'], r['phase'], r['points_per_s'] / old['points_per_s']))
+        with open(args.compare) as f:
+            old_results = json.load(f)
+        old_formats = old_results.get('formats', {})
+        for format, r in results['formats'].items():
+            old = old_formats.get(format)
+            if old and r['write_seconds']:
+                print('%-14s %-10s %6.2fx' % ('format', format, old['write_seconds'] / r['write_seconds']))
+        old_io = old_results.get('io', {})
+        if old_io:
+            print('\n%-14s %22s %22s %22s' % ('case', 'alloc peak MB', 'reads', 'read syscalls'))
+        for name, r in results['io'].items():
+            old = old_io.get(name)
+            if old:
+                print('%-14s %10.1f -> %8.1f %10d -> %8d %10s -> %8s' % (name,
+                      old['alloc_peak'] / 1e6, r['alloc_peak'] / 1e6, old['reads'], r['reads'],
+                      old['read_syscalls'], r['read_syscalls']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+'''
+Synthetic AlpineQuest files for benchmarks.
+
+Writes valid .trk files of version 2, 3 (fixed size locations, with or
+without accuracy/pressure) and 4 (tagged e/t/a/p locations, summary
+block), and .ldk archives with nested nodes, empty entry slots, data
+split over chained additional data blocks and, besides tracks,
+waypoint, set, route and area entries. damage() makes a truncated or
+corrupted copy of any of them, for the partial decode mode.
+
+    python synth.py trk --version 3 --points 100000 --segments 4 out.trk
+    python synth.py ldk --depth 3 --fanout 2 --entries 2 --blocks 3 out.ldk
+    python synth.py damage --seed 7 out.trk damaged.trk
+'''
+
+import sys
+import random
+import argparse
+from struct import Struct, pack
+
+T0 = 1587216396000      # ms, first location
+NO_HEIGHT = -999999999
+NO_PRESSURE = 999999999
+
+RECORDS = {
+    0: Struct('>llllq'),        # size, lon, lat, alt, ts
+    1: Struct('>llllql'),       # + accuracy
+    2: Struct('>llllqll'),      # + pressure
+}
+
+
+def metadata(entries, version):
+    # {Metadata}: strings, longs (int) and doubles (float)
+    out = [pack('>l', len(entries))]
+    for key, value in entries.items():
+        key = key.encode('utf-8')
+        out.append(pack('>l', len(key)) + key)
+        if isinstance(value, float):
+            out.append(pack('>ld', -3, value))
+        elif isinstance(value, int):
+            out.append(pack('>lq', -2, value))
+        else:
+            value = value.encode('utf-8')
+            out.append(pack('>l', len(value)) + value)
+    if version == 3:
+        out.append(pack('>l', 0))
+    return b''.join(out)
+
+
+def location(version, lon, lat, alt, ts, acc=None, bar=None):
+    if version <= 3:
+        extra = 0 if acc is None else 1 if bar is None else 2
+        fields = (lon, lat, alt, ts) + ((acc,) if extra else ()) + ((bar,) if extra == 2 else ())
+        record = RECORDS[extra]
+        return record.pack(record.size - 4, *fields)
+    body = pack('>ll', lon, lat) + b'e' + pack('>l', alt) + b't' + pack('>q', ts)
+    if acc is not None:
+        body += b'a' + pack('>l', acc)
+    if bar is not None:
+        body += b'p' + pack('>l', bar)
+    return pack('>l', len(body)) + body
+
+
+class Walk(object):
+    # random walk around a start point, 1 location per second
+    def __init__(self, seed, version):
+        self.rnd = random.Random(seed)
+        self.version = version
+        self.lon, self.lat, self.alt, self.ts = 88924166, 465760833, 2376000, T0
+
+    def step(self, extra):
+        rnd = self.rnd
+        self.lon += rnd.randint(-200, 200)
+        self.lat += rnd.randint(-200, 200)
+        self.alt += rnd.randint(-500, 500)
+        self.ts += 1000 + (rnd.randint(0, 999) if self.version == 4 else 0)
+        alt = NO_HEIGHT if rnd.random() < 0.01 else self.alt
+        acc = rnd.randint(3, 20) if extra >= 1 else None
+        bar = (NO_PRESSURE if rnd.random() < 0.01 else rnd.randint(700000, 1013000)) if extra >= 2 else None
+        return self.lon, self.lat, alt, self.ts, acc, bar
+
+
+def trk(version=3, points=1000, segments=1, waypoints=0, name='Synthetic track',
+        extra=2, mixed=False, seed=0):
+    '''
+    .trk file content: segments segments of points locations each.
+    extra: 0 no accuracy/pressure, 1 accuracy, 2 both (versions <= 3);
+    mixed varies the record size from one location to the next.
+    '''
+    walk = Walk(seed, version)
+    segs = [pack('>l', segments)]
+    first = None
+    for s in range(segments):
+        if version < 3:
+            segs.append(pack('>l', 0))
+        else:
+            segs.append(metadata({}, version))
+            if version == 4:
+                segs.append(pack('>ll', 0, -1))
+        segs.append(pack('>l', points))
+        for i in range(points):
+            values = walk.step((extra + i) % 3 if mixed else extra)
+            if first is None:
+                first = values
+            segs.append(location(version, *values))
+    wpts = [pack('>l', waypoints)]
+    for w in range(waypoints):
+        wpts.append(metadata({'name': 'WP %d' % w}, version))
+        wpts.append(location(version, 88920000 + 1000 * w, 465760000, 2372000, T0))
+    meta = metadata({'name': name} if name else {}, version)
+    first = first or (0, 0, 0, T0, None, None)
+    if version <= 3:
+        header = pack('>lllllq', segments * points, segments, waypoints, first[0], first[1], first[3])
+        header += pack('>dddq', 10.0 * segments * points, 10.5 * segments * points, 1.5 * segments * points,
+                       segments * points)
+        return b''.join([pack('>ll', version, len(header)), header, meta] + wpts + segs)
+    summary = metadata({'dte': first[3]}, 4)
+    return b''.join([pack('>ll', 0x50500e01, 0), summary, pack('>ll', 3, -1), meta, pack('>ll', 0, -1)]
+                    + wpts + segs)
+
+
+def landmarks(kind, version=3, points=5, name='Synthetic', seed=0):
+    '''
+    Content of a wpt, set, rte (points waypoints) or are (an outline of
+    points locations) file, version 2 or 3.
+    '''
+    rnd = random.Random(seed)
+    locations = [(88920000 + rnd.randint(-5000, 5000), 465760000 + rnd.randint(-5000, 5000),
+                  2372000 + rnd.randint(-1000, 1000), T0 + 60000 * i) for i in range(points)]
+    meta = metadata({'name': name}, version)
+    if kind == 'wpt':
+        header = pack('>ll', *locations[0][:2])
+        body = location(version, *locations[0])
+    elif kind in ('set', 'rte'):
+        header = pack('>lll', points, *locations[0][:2])
+        if kind == 'rte':
+            header += pack('>ddd', 100.0 * points, 101.0 * points, 10.0 * points)
+        body = pack('>l', points) + b''.join(metadata({'name': '%s %d' % (name, i)}, version)
+                                              + location(version, *values) for i, values in enumerate(locations))
+    else:
+        header = pack('>lldd', locations[0][0], locations[0][1], 400.0 * points, 10000.0 * points)
+        body = pack('>l', points + 1) + b''.join(location(version, *values)
+                                                 for values in locations + locations[:1])
+    return pack('>ll', version, len(header)) + header + meta + body
+
+
+def _data(buf, payload, blocks=1):
+    # {NodeData} with payload split over blocks chained blocks
+    n = len(payload)
+    cuts = [n * i // blocks for i in range(blocks + 1)]
+    parts = [payload[cuts[i]:cuts[i + 1]] for i in range(blocks)]
+    following = 0
+    for part in reversed(parts[1:]):
+        offset = len(buf)
+        buf += pack('>lqQ', 0x00205555, len(part), following) + part
+        following = offset
+    offset = len(buf)
+    buf += pack('>llqqQ', 0x00105555, 0, n, len(parts[0]), following) + parts[0]
+    return offset
+
+
+def _entries(children, data, empty, following):
+    # {NodeEntries} list, following: pointer to the additional entries
+    return b''.join([pack('>llllQ', 0x00025555, len(children) + len(data) + empty, len(children), len(data),
+                          following)] + [pack('>Ql', *entry) for entry in children] + [b'\0' * (12 * empty)]
+                    + [pack('>Ql', *entry) for entry in data])
+
+
+def _node(buf, node):
+    children = [(_node(buf, child), child.get('uuid', 0)) for child in node.get('children', [])]
+    data = [(_data(buf, bytes([kind]) + payload, blocks), uuid)
+            for kind, payload, blocks, uuid in node.get('data', [])]
+    meta = _data(buf, metadata({'name': node['name']} if node.get('name') else {}, 2))
+    # entries over lists of at most chain entries, chained by their pointer
+    items = [(True, entry) for entry in children] + [(False, entry) for entry in data]
+    size = node.get('chain') or len(items) or 1
+    lists = [items[i:i + size] for i in range(0, len(items), size)] or [[]]
+    following = 0
+    if not node.get('compact'):
+        for part in reversed(lists[1:]):
+            offset = len(buf)
+            buf += _entries([e for child, e in part if child], [e for child, e in part if not child], 0, following)
+            following = offset
+    offset = len(buf)
+    buf += pack('>llQd', 0x00015555, 0, meta, 0.0)
+    if node.get('compact'):
+        buf += pack('>lll', 0x00045555, len(children), len(data))
+        buf += b''.join(pack('>Ql', *entry) for entry in children + data)
+    else:
+        buf += _entries([e for child, e in lists[0] if child], [e for child, e in lists[0] if not child],
+                        node.get('empty', 0), following)
+    return offset
+
+
+def ldk_tree(root):
+    '''
+    .ldk archive content from a node tree: dicts with name, uuid, children,
+    data (list of (type, payload, blocks, uuid)), empty slots, compact
+    (table of entries), chain (at most this many entries per list, the
+    others in additional lists).
+    '''
+    buf = bytearray(48)
+    root_offset = _node(buf, root)
+    pack_into = Struct('>llQ').pack_into
+    pack_into(buf, 0, 0x4C444B3A, 1, root_offset)
+    return bytes(buf)
+
+
+def ldk(depth=2, fanout=2, entries=2, blocks=2, empty=1, points=100, version=None, seed=0, chain=0,
+        waypoints=0, kinds=()):
+    '''
+    .ldk archive: a folder tree depth levels deep with fanout sub-folders per
+    folder, entries trk entries per folder (alternating .trk versions 3 and
+    4 unless version is given, with waypoints waypoints each), each split
+    over blocks data blocks, with at most chain entries per entry list
+    when given. kinds: other entry types (wpt, set, rte, are) added to
+    each folder, one of each.
+    '''
+    kind_types = {'wpt': 101, 'set': 102, 'rte': 103, 'are': 105}
+    uuids = iter(range(0x1000, 0x7fffffff))
+
+    def folder(level, name):
+        node = {'name': name, 'uuid': next(uuids), 'empty': empty, 'compact': level % 2 == 1,
+                'chain': chain, 'children': [], 'data': []}
+        for e in range(entries):
+            v = version if version else (3, 4)[e % 2]
+            payload = trk(v, points=points, waypoints=waypoints, name='%s track %d' % (name, e),
+                          seed=seed + node['uuid'] + e)
+            node['data'].append((104, payload, blocks, next(uuids)))
+        for kind in kinds:
+            payload = landmarks(kind, 2 + level % 2, name='%s %s' % (name, kind), seed=seed + node['uuid'])
+            node['data'].append((kind_types[kind], payload, blocks, next(uuids)))
+        if level < depth:
+            for f in range(fanout):
+                node['children'].append(folder(level + 1, '%s.%d' % (name, f) if name else 'folder %d' % f))
+        return node
+
+    root = folder(0, '')
+    root.pop('name')
+    return ldk_tree(root)
+
+
+def damage(data, seed=0, cut=None, flips=4):
+    # a copy of data cut at a random offset (cut=True), or with flips random
+    # bytes overwritten (cut=False); by default one or the other from the seed
+    rnd = random.Random(seed)
+    if cut is None:
+        cut = rnd.random() < 0.5
+    if cut:
+        return data[:rnd.randrange(len(data))]
+    damaged = bytearray(data)
+    for i in range(flips):
+        damaged[rnd.randrange(len(damaged))] = rnd.randrange(256)
+    return bytes(damaged)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='write synthetic AlpineQuest files')
+    sub = parser.add_subparsers(dest='kind', required=True)
+    p = sub.add_parser('trk')
+    p.add_argument('--version', type=int, default=3, choices=(2, 3, 4))
+    p.add_argument('--points', type=int, default=1000, help='locations per segment')
+    p.add_argument('--segments', type=int, default=1)
+    p.add_argument('--waypoints', type=int, default=0)
+    p.add_argument('--extra', type=int, default=2, choices=(0, 1, 2),
+                   help='0: no accuracy/pressure, 1: accuracy, 2: both')
+    p.add_argument('--mixed', action='store_true', help='mix record sizes')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('output')
+    p = sub.add_parser('ldk')
+    p.add_argument('--depth', type=int, default=2)
+    p.add_argument('--fanout', type=int, default=2)
+    p.add_argument('--entries', type=int, default=2, help='trk entries per node')
+    p.add_argument('--blocks', type=int, default=2, help='data blocks per entry')
+    p.add_argument('--empty', type=int, default=1, help='empty entry slots per node')
+    p.add_argument('--points', type=int, default=100, help='locations per entry')
+    p.add_argument('--chain', type=int, default=0, help='entries per list of a node (0: all in one)')
+    p.add_argument('--waypoints', type=int, default=0, help='waypoints per trk entry')
+    p.add_argument('--kinds', default='', help='other entries per node, comma separated: wpt,set,rte,are')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('output')
+    p = sub.add_parser('damage')
+    p.add_argument('--cut', action='store_true', help='truncate (default: from the seed)')
+    p.add_argument('--flips', type=int, default=0, help='corrupt this many bytes (default: from the seed)')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('input')
+    p.add_argument('output')
+    args = parser.parse_args(argv)
+
+    if args.kind == 'damage':
+        with open(args.input, 'rb') as f:
+            data = damage(f.read(), args.seed, cut=True if args.cut else False if args.flips else None,
+                          flips=args.flips or 4)
+    elif args.kind == 'trk':
+        data = trk(args.version, args.points, args.segments, args.waypoints,
+                   extra=args.extra, mixed=args.mixed, seed=args.seed)
+    else:
+        data = ldk(args.depth, args.fanout, args.entries, args.blocks, args.empty,
+                   args.points, seed=args.seed, chain=args.chain, waypoints=args.waypoints,
+                   kinds=[kind for kind in args.kinds.split(',') if kind])
+    with open(args.output, 'wb') as f:
+        f.write(data)
+
+
+if __name__ == '__main__':
+    sys.exit(main())